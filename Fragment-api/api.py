@@ -1,7 +1,9 @@
 import asyncio
 import base64
+import importlib.util
 import re
 import httpx
+from pytoniq_core import Cell
 from tonutils.client import TonapiClient
 from tonutils.wallet import WalletV5R1
 
@@ -32,6 +34,12 @@ FRAGMENT_PUBLICKEY = "91b296c356bb0894b40397b54565c11f4b29ea610b8e14d2ae13Efis5d
 FRAGMENT_WALLETS = "te6cckECFgEAArEAAgE0AQsBFP8A9KQT9LzyyAsCAgEgAwYCAUgMBAIBIAgFABm+Xw9qJoQICg65D6AsAQLyBwEeINcLH4IQc2lnbrry4Ip/DQIBIAkTAgFuChIAGa3OdqJoQCDrkOuF/8AAUYAAAAA///+Il7w6CtQZIMze2+aVZS87QjJHoU5yqUljL1aSwzvDrCugAtzQINdJwSCRW49jINcLHyCCEGV4dG69IYIQc2ludL2wkl8D4IIQZXh0brqOtIAg1yEB0HTXIfpAMPpE+Cj6RDBYvZFb4O1E0IEBQdch9AWDB/QOb6ExkTDhgEDXIXB/2zzgMSDXSYECgLmRMOBw4g4NAeaO8O2i7fshgwjXIgKDCNcjIIAg1yHTH9Mf0x/tRNDSANMfINMf0//XCgAK+QFAzPkQmiiUXwrbMeHywIffArNQB7Dy0IRRJbry4IVQNrry4Ib4I7vy0IgikvgA3gGkf8jKAMsfAc8Wye1UIJL4D95w2zzYDgP27aLt+wL0BCFukmwhjkwCIdc5MHCUIccAs44tAdcoIHYeQ2wg10nACPLgkyDXSsAC8uCTINcdBscSwgBSMLDy0InXTNc5MAGk6GwShAe78uCT10rAAPLgk+1V4tIAAcAAkVvg69csCBQgkXCWAdcsCBwS4lIQseMPINdKERAPABCTW9sx4ddM0AByMNcsCCSOLSHy4JLSAO1E0NIAURO68tCPVFAwkTGcAYEBQNch1woA8uCO4sjKAFjPFsntVJPywI3iAJYB+kAB+kT4KPpEMFi68uCR7UTQgQFB1xj0BQSdf8jKAEAEgwf0U/Lgi44UA4MH9Fvy4Iwi1woAIW4Bs7Dy0JDiyFADzxYS9ADJ7VQAGa8d9qJoQBDrkOuFj8ACAUgVFAARsmL7UTQ1woAgABezJftRNBx1yHXCx+B27MAq"
 FRAGMENT_ADDRES = "0:20c429e3bb195f46a582c10eb687c6ed182ec58237a55787f245ec992c337118"
 
+# Параметры HTTP клиента (HTTP/2 включается только если установлен пакет h2)
+HTTP2 = False
+HTTP_TIMEOUT = 15.0
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_MAX_CONNECTIONS = 20
+
 
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ 
 def get_cookies(data):
@@ -44,6 +52,26 @@ def get_cookies(data):
     }
 
 
+def create_http_client():
+    # Долгоживущий клиент с keep-alive: TCP+TLS рукопожатие с fragment.com один раз на процесс
+    return httpx.AsyncClient(
+        http2=HTTP2 and importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=60,
+        ),
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+
+# Декодер payload (файл самодостаточный; бот текст комментария не декодирует, а отправляет ячейку из payload)
+# Печатные ASCII остаются как есть, все остальные байты превращаются в пробел за один проход
+PRINTABLE = bytes(b if 32 <= b < 127 else 32 for b in range(256))
+# Число звезд ищется как отдельное число: "5 Telegram Stars" не совпадет внутри "15 Telegram Stars"
+STARS_PATTERN = re.compile(rb"(?<!\d)(\d+) Telegram Stars")
+
+
 def fix_base64_padding(b64_string: str) -> str:
     # Исправляет padding в Base64 строке
     missing_padding = len(b64_string) % 4
@@ -52,13 +80,30 @@ def fix_base64_padding(b64_string: str) -> str:
     return b64_string
 
 
+def decode_payload(payload_base64: str, stars_count: int) -> str:
+    # Текст из payload: начиная с "<stars_count> Telegram Stars", иначе весь очищенный текст
+    text = b" ".join(base64.b64decode(fix_base64_padding(payload_base64)).translate(PRINTABLE).split())
+    wanted = str(stars_count).encode()
+    for match in STARS_PATTERN.finditer(text):
+        if match.group(1) == wanted:
+            text = text[match.start():]
+            break
+    return text.decode("ascii")
+
+
+def comment_cell(payload_base64: str) -> Cell:
+    # Ячейка комментария из payload как есть (pytoniq_core ставится вместе с tonutils)
+    return Cell.one_from_boc(base64.b64decode(fix_base64_padding(payload_base64)))
+
+
 # FRAGMENT CLIENT 
 class FragmentClient:
     # Клиент для работы с Fragment API
     
-    def __init__(self, fragment_hash: str, cookies_data: dict):
+    def __init__(self, fragment_hash: str, cookies_data: dict, http_client: httpx.AsyncClient):
         self.url = f"https://fragment.com/api?hash={fragment_hash}"
         self.cookies = get_cookies(cookies_data)
+        self.http_client = http_client
     
     async def fetch_recipient(self, query: str):
         # Поиск получателя по username
@@ -69,11 +114,10 @@ class FragmentClient:
             "method": "searchStarsRecipient"
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(self.url, cookies=self.cookies, data=data)
-            result = response.json()
-            print("Recipient search:", result)
-            return result.get("found", {}).get("recipient")
+        response = await self.http_client.post(self.url, cookies=self.cookies, data=data)
+        result = response.json()
+        print("Recipient search:", result)
+        return result.get("found", {}).get("recipient")
     
     async def fetch_req_id(self, recipient: str, quantity: int):
         # Инициализация запроса на покупку звезд
@@ -85,11 +129,10 @@ class FragmentClient:
             "method": "initBuyStarsRequest"
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(self.url, cookies=self.cookies, data=data)
-            result = response.json()
-            print("Request ID:", result)
-            return result.get("req_id")
+        response = await self.http_client.post(self.url, cookies=self.cookies, data=data)
+        result = response.json()
+        print("Request ID:", result)
+        return result.get("req_id")
     
     async def fetch_buy_link(self, recipient: str, req_id: str, quantity: int):
         # Получение данных для транзакции TON
@@ -120,15 +163,14 @@ class FragmentClient:
             "x-requested-with": "XMLHttpRequest"
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(self.url, headers=headers, cookies=self.cookies, data=data)
-            json_data = response.json()
-            print("Buy link:", json_data)
-            
-            if json_data.get("ok") and "transaction" in json_data:
-                transaction = json_data["transaction"]
-                msg = transaction["messages"][0]
-                return msg["address"], msg["amount"], msg["payload"]
+        response = await self.http_client.post(self.url, headers=headers, cookies=self.cookies, data=data)
+        json_data = response.json()
+        print("Buy link:", json_data)
+        
+        if json_data.get("ok") and "transaction" in json_data:
+            transaction = json_data["transaction"]
+            msg = transaction["messages"][0]
+            return msg["address"], msg["amount"], msg["payload"]
         
         return None, None, None
 
@@ -140,23 +182,22 @@ class TonTransaction:
     def __init__(self, api_key: str, mnemonic: list):
         self.api_key = api_key
         self.mnemonic = mnemonic
+        self.wallet = None
+    
+    def get_wallet(self):
+        # Кошелек выводится из мнемоники один раз на экземпляр TonTransaction
+        if self.wallet is None:
+            client = TonapiClient(api_key=self.api_key, is_testnet=False)
+            self.wallet, public_key, private_key, mnemonic = WalletV5R1.from_mnemonic(
+                client, self.mnemonic
+            )
+        return self.wallet
     
     def decode_payload(self, payload_base64: str, stars_count: int) -> str:
         # Декодирует payload из Base64 и форматирует
         # Args: payload_base64 - закодированный payload, stars_count - количество звезд
         # Returns: отформатированный текст для транзакции
-        # Декодирование Base64
-        decoded_bytes = base64.b64decode(fix_base64_padding(payload_base64))
-        
-        # Преобразование в читаемый текст
-        decoded_text = "".join(chr(b) if 32 <= b < 127 else " " for b in decoded_bytes)
-        
-        # Очистка от лишних пробелов
-        clean_text = re.sub(r"\s+", " ", decoded_text).strip()
-        
-        # Извлечение нужной части (от "X Telegram Stars")
-        match = re.search(rf"{stars_count} Telegram Stars.*", clean_text)
-        return match.group(0) if match else clean_text
+        return decode_payload(payload_base64, stars_count)
     
     async def send_transaction(self, recipient_address: str, amount_nano: float, 
                               payload: str, stars_count: int):
@@ -164,22 +205,19 @@ class TonTransaction:
         # Args: recipient_address - адрес получателя, amount_nano - сумма в TON
         #       payload - данные транзакции (Base64), stars_count - количество звезд
         # Returns: transaction hash если успешно, иначе None
-        # Создание клиента TON
-        client = TonapiClient(api_key=self.api_key, is_testnet=False)
+        # Кошелек (создается при первой транзакции и переиспользуется)
+        wallet = self.get_wallet()
         
-        # Загрузка кошелька из мнемоники
-        wallet, public_key, private_key, mnemonic = WalletV5R1.from_mnemonic(
-            client, self.mnemonic
-        )
-        
-        # Декодирование payload
-        body_text = self.decode_payload(payload, stars_count)
+        # Комментарий уходит ячейкой из payload без изменений: очищенный текст теряет переводы строк
+        # и продолжение длинного комментария в дочерней ячейке
+        print(f"Комментарий: {self.decode_payload(payload, stars_count)}")
+        body = comment_cell(payload)
         
         # Отправка транзакции
         tx_hash = await wallet.transfer(
             destination=recipient_address,
             amount=amount_nano,
-            body=body_text
+            body=body
         )
         
         print(f"✅ Транзакция отправлена: {tx_hash}")
@@ -189,15 +227,16 @@ class TonTransaction:
 # ОСНОВНОЙ ПРОЦЕСС ПОКУПКИ 
 async def buy_stars(username: str, stars_count: int, 
                    fragment_hash: str, cookies_data: dict,
-                   ton_api_key: str, mnemonic: list):
+                   ton: "TonTransaction",
+                   http_client: httpx.AsyncClient):
                      # Полный процесс покупки звезд
     # Args: username - @username получателя, stars_count - количество звезд
     #       fragment_hash - hash для Fragment API, cookies_data - cookies для авторизации
-    #       ton_api_key - API ключ для TON, mnemonic - мнемоническая фраза кошелька
+    #       ton - общий TonTransaction, кошелек выводится из мнемоники один раз и переиспользуется между покупками
+    #       http_client - общий HTTP клиент (create_http_client), переиспользуется между покупками
     # Returns: (success, tx_hash) - результат операции
     # Инициализация клиентов
-    fragment = FragmentClient(fragment_hash, cookies_data)
-    ton = TonTransaction(ton_api_key, mnemonic)
+    fragment = FragmentClient(fragment_hash, cookies_data, http_client)
     
     # Шаг 1: Поиск получателя
     print(f"Шаг 1: Поиск получателя {username}...")
@@ -245,15 +284,17 @@ async def main():
     username = "@example"  # Username получателя
     stars_count = 100      # Количество звезд
     
-    # Выполнение покупки
-    success, tx_hash = await buy_stars(
-        username=username,
-        stars_count=stars_count,
-        fragment_hash=FRAGMENT_HASH,
-        cookies_data=DATA,
-        ton_api_key=API_TON,
-        mnemonic=MNEMONIC
-    )
+    # Клиент и кошелек создаются один раз и передаются во все покупки
+    ton = TonTransaction(API_TON, MNEMONIC)
+    async with create_http_client() as http_client:
+        success, tx_hash = await buy_stars(
+            username=username,
+            stars_count=stars_count,
+            fragment_hash=FRAGMENT_HASH,
+            cookies_data=DATA,
+            ton=ton,
+            http_client=http_client
+        )
     
     if success:
         print(f"\n🎉 Покупка завершена!")
@@ -0,0 +1,102 @@
+import base64
+import os
+import re
+import sys
+import time
+from pytoniq_core import begin_cell
+from api import PRINTABLE, comment_cell, decode_payload, fix_base64_padding
+
+# Замер decode_payload из api.py: прежний вариант (chr по байтам, re.sub, regex на каждый вызов)
+# против текущего. Перед замером проверяются эталоны; при расхождении скрипт завершается с ошибкой.
+# Эталоны - настоящие payload из ответов getBuyStarsLink в payload_fixtures.txt (строки "<звезд> <payload>").
+# Бот записывает их в файл PAYLOAD_CAPTURE_FILE, новые строки дописываются в payload_fixtures.txt.
+# Вместе с ними проверяются образцы, собранные здесь же из текста комментария: они покрывают крайние случаи
+# (payload без padding, комментарий во второй ячейке).
+# Запуск из Fragment-api: python3 bench_payload.py [calls] [payload_fixtures.txt]
+
+FIXTURES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payload_fixtures.txt")
+
+# (звезд, точный текст комментария)
+SAMPLES = [
+    (50, "50 Telegram Stars \n\nRef#Kx9aB2"),
+    (1000, "1000 Telegram Stars for @durov\n\nRef#Q1w2E3r4"),
+    (15, "15 Telegram Stars\t\tRef#zz"),
+    # Длинный комментарий продолжается во второй ячейке
+    (500, "500 Telegram Stars " + "x" * 150 + " Ref#long"),
+]
+
+def build_payload(comment):
+    cell = begin_cell().store_uint(0, 32).store_snake_string(comment).end_cell()
+    return base64.b64encode(cell.to_boc()).decode()
+
+def build_samples():
+    samples = [(build_payload(comment), stars, comment) for stars, comment in SAMPLES]
+    # Fragment присылает payload и без padding
+    payload, stars, comment = samples[2]
+    return samples[:2] + [(payload.rstrip("="), stars, comment)] + samples[3:]
+
+def load_captured(path):
+    # (payload, звезд, None): точный комментарий берется из самого payload
+    with open(path) as f:
+        lines = [line.split() for line in f if line.strip() and not line.startswith("#")]
+    return [(payload, int(stars), None) for stars, payload in lines]
+
+def comment_text(payload):
+    # Точный текст комментария: после 32-битного op = 0 идет snake-строка
+    cell_slice = comment_cell(payload).begin_parse()
+    if cell_slice.load_uint(32) != 0:
+        raise ValueError("payload не является текстовым комментарием")
+    return cell_slice.load_snake_string()
+
+def clean_text(text):
+    return " ".join(text.encode().translate(PRINTABLE).decode().split())
+
+def legacy_decode_payload(payload, stars):
+    decoded_bytes = base64.b64decode(fix_base64_padding(payload))
+    decoded_text = "".join(chr(b) if 32 <= b < 127 else " " for b in decoded_bytes)
+    clean_text = re.sub(r"\s+", " ", decoded_text).strip()
+    match = re.search(rf"{stars} Telegram Stars.*", clean_text)
+    return match.group(0) if match else clean_text
+
+def check(golden):
+    for payload, stars, expected in golden:
+        # В перевод уходит ячейка из payload как есть: она должна разбираться в текстовый комментарий с числом звезд
+        comment = comment_text(payload)
+        if expected is not None and comment != expected:
+            sys.exit(f"comment_text: {stars} звезд: ожидалось {expected!r}, получено {comment!r}")
+        if not comment.startswith(f"{stars} Telegram Stars"):
+            sys.exit(f"comment_text: {stars} звезд: комментарий {comment!r} не начинается с числа звезд")
+        # Текстовый путь должен давать то же, что прежний декодер
+        result, legacy = decode_payload(payload, stars), legacy_decode_payload(payload, stars)
+        if result != legacy:
+            sys.exit(f"decode_payload: {stars} звезд: прежний декодер дал {legacy!r}, получено {result!r}")
+        # и точный текст для комментария в одной ячейке (продолжение в дочерней ячейке текстовый путь не восстанавливает)
+        if len(comment_cell(payload).refs) == 0 and result != clean_text(comment):
+            sys.exit(f"decode_payload: {stars} звезд: ожидалось {clean_text(comment)!r}, получено {result!r}")
+    # "5 Telegram Stars" не должно находиться внутри "15 Telegram Stars"
+    if decode_payload(build_payload("15 Telegram Stars"), 5).startswith("5 Telegram Stars"):
+        sys.exit("decode_payload: число звезд найдено внутри другого числа")
+
+def measure(decode, golden, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        for payload, stars, _ in golden:
+            decode(payload, stars)
+    return (time.perf_counter() - start) / (calls * len(golden)) * 1_000_000
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    captured = load_captured(sys.argv[2] if len(sys.argv) > 2 else FIXTURES_FILE)
+    if not captured:
+        print("нет записанных payload: проверка только на собранных образцах", file=sys.stderr)
+    golden = captured + build_samples()
+    check(golden)
+    print(f"эталоны совпали: записанных {len(captured)}, собранных {len(golden) - len(captured)}")
+    before = measure(legacy_decode_payload, golden, calls)
+    after = measure(decode_payload, golden, calls)
+    print(f"calls={calls}, мкс на вызов")
+    print(f"{'legacy':>10}{'api':>10}{'speedup':>10}")
+    print(f"{before:>10.2f}{after:>10.2f}{before / after:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import re
+import time
+import httpx
+import config
+from cache import MISSING, TTLCache
+
+GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_MODEL = "llama3-8b-8192"
+UNAVAILABLE_TEXT = "Извините, ИИ-помощник временно недоступен."
+INTERRUPTED_TEXT = "⚠️ Ответ прерван: ИИ-помощник временно недоступен."
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+groq_client = None
+# Ответы на частые вопросы ("как купить звезды", "сколько ждать") одинаковы, LLM повторно не спрашиваем
+answer_cache = TTLCache(maxsize=config.AI_CACHE_SIZE, ttl=config.AI_CACHE_TTL)
+# Одинаковые вопросы, заданные одновременно, ждут один запрос к Groq
+in_flight = {}
+
+def get_groq_client():
+    global groq_client
+    if groq_client is None or groq_client.is_closed:
+        groq_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=config.HTTP_MAX_CONNECTIONS, keepalive_expiry=60),
+            timeout=httpx.Timeout(30.0, connect=config.HTTP_CONNECT_TIMEOUT),
+        )
+    return groq_client
+
+async def close_groq_client():
+    global groq_client
+    if groq_client is not None:
+        await groq_client.aclose()
+        groq_client = None
+
+def normalize_question(text):
+    text = text.lower().replace("ё", "е")
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+def build_request(question):
+    return {
+        "model": GROQ_MODEL,
+        "stream": True,
+        "messages": [
+            {"role": "system", "content": f"Ты помощник магазина {config.SHOP_NAME}. Мы продаем Telegram Stars. Отвечай кратко и по делу на русском языке."},
+            {"role": "user", "content": question}
+        ]
+    }
+
+def get_headers():
+    return {
+        "Authorization": f"Bearer {config.GROQ_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+class AnswerStream:
+    # Ответ, который еще генерируется: один запрос к Groq дописывает текст,
+    # любое число читателей получает его по мере появления
+    def __init__(self):
+        self.text = ""
+        self.done = False
+        self.failed = False
+        self.changed = asyncio.Condition()
+
+    async def push(self, text, done=False, failed=False):
+        async with self.changed:
+            self.text = text
+            self.done = done
+            self.failed = failed
+            self.changed.notify_all()
+
+    async def follow(self):
+        seen = None
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.text != seen or self.done)
+                text, done = self.text, self.done
+            if text != seen:
+                seen = text
+                yield text
+            if done:
+                return
+
+async def request_answer(question, stream):
+    text = ""
+    started = time.monotonic()
+    first_token = None
+    try:
+        async with get_groq_client().stream("POST", GROQ_URL, headers=get_headers(), json=build_request(question)) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Groq вернул {response.status_code}")
+            # Server-sent events: строки "data: {...}", поток заканчивается "data: [DONE]"
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if not delta:
+                    continue
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                text += delta
+                await stream.push(text)
+    except Exception as e:
+        logging.error(f"Ошибка запроса к Groq: {e}")
+        await stream.push(text, done=True, failed=True)
+        return
+    if first_token is not None:
+        logging.info(f"Groq: первый токен через {first_token:.2f} с, ответ за {time.monotonic() - started:.2f} с")
+    await stream.push(text, done=True, failed=not text)
+    if text:
+        answer_cache.set(normalize_question(question), text)
+
+async def stream_groq_response(question):
+    # Отдает текст ответа по мере генерации (каждый раз целиком, а не приращение)
+    key = normalize_question(question)
+    answer = answer_cache.get(key)
+    if answer is not MISSING:
+        yield answer
+        return
+    stream = in_flight.get(key)
+    if stream is None:
+        stream = AnswerStream()
+        in_flight[key] = stream
+        task = asyncio.create_task(request_answer(question, stream))
+        task.add_done_callback(lambda t: in_flight.pop(key, None))
+    text = ""
+    async for text in stream.follow():
+        if text:
+            yield text
+    if stream.failed:
+        # Оборванный ответ не выдаем за полный
+        yield f"{text}\n\n{INTERRUPTED_TEXT}" if text else UNAVAILABLE_TEXT
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    # Telegram не принимает сообщения длиннее 4096 символов: длинный ответ режется по переносу строки или пробелу
+    parts = []
+    while len(text) > limit:
+        # Слишком ранний разрез дал бы почти пустое сообщение
+        cut = text.rfind("\n", limit // 2, limit)
+        if cut == -1:
+            cut = text.rfind(" ", limit // 2, limit)
+        if cut == -1:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return parts
+
+async def get_groq_response(question):
+    answer = UNAVAILABLE_TEXT
+    async for answer in stream_groq_response(question):
+        pass
+    return answer
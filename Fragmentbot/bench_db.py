@@ -0,0 +1,89 @@
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from cache import TTLCache
+from database import Database
+
+# Замер задержки одного вызова Database: старый вариант (новое соединение
+# на каждый вызов) против постоянного соединения с WAL и настроенным кэшем.
+# Запуск: python3 bench_db.py [users] [transactions] [calls]
+
+class ConnectPerCallDatabase(Database):
+    # Прежнее поведение целиком: без кэша пользователей и без write-behind очереди,
+    # иначе get_balance и add_transaction в обоих вариантах не доходят до соединения
+    def __init__(self, db_name):
+        super().__init__(db_name)
+        self.users_cache = TTLCache(maxsize=0)
+
+    def write_later(self, sql, params):
+        with self.get_cursor() as cursor:
+            cursor.execute(sql, params)
+
+    @contextmanager
+    def get_cursor(self):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        finally:
+            conn.close()
+
+def fill(db, users, transactions):
+    with db.get_cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO users (user_id, username, first_name, balance) VALUES (?, ?, ?, ?)",
+            ((i, f"user{i}", f"User {i}", random.uniform(0, 1000)) for i in range(1, users + 1)),
+        )
+        cursor.executemany(
+            "INSERT INTO transactions (user_id, type, amount, description) VALUES (?, ?, ?, ?)",
+            ((random.randint(1, users), random.choice(("deposit", "purchase", "bonus")), random.uniform(1, 100), "bench")
+             for _ in range(transactions)),
+        )
+        cursor.executemany(
+            "INSERT INTO star_purchases (user_id, recipient_username, stars_amount, balance_spent, status) VALUES (?, ?, ?, ?, ?)",
+            ((random.randint(1, users), "@bench", random.randint(50, 5000), random.uniform(100, 10000), "completed")
+             for _ in range(transactions // 4)),
+        )
+
+def measure(db, users, calls):
+    results = {}
+    ids = [random.randint(1, users) for _ in range(calls)]
+    cases = {
+        "get_balance": lambda uid: db.get_balance(uid),
+        "get_user_star_purchases": lambda uid: db.get_user_star_purchases(uid, 10),
+        "add_balance": lambda uid: db.add_balance(uid, 1),
+        "add_transaction": lambda uid: db.add_transaction(uid, "bonus", 1, "bench"),
+        "get_user_transactions": lambda uid: db.get_user_transactions(uid, "deposit", 10),
+    }
+    for name, case in cases.items():
+        start = time.perf_counter()
+        for uid in ids:
+            case(uid)
+        results[name] = (time.perf_counter() - start) / calls * 1_000_000
+    return results
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    transactions = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+    calls = int(sys.argv[3]) if len(sys.argv) > 3 else 2_000
+    with tempfile.TemporaryDirectory() as tmp:
+        rows = {}
+        for label, cls in (("connect-per-call", ConnectPerCallDatabase), ("persistent", Database)):
+            db = cls(os.path.join(tmp, f"{label}.db"))
+            fill(db, users, transactions)
+            rows[label] = measure(db, users, calls)
+            db.close()
+    print(f"users={users} transactions={transactions} calls={calls}, мкс на вызов")
+    print(f"{'method':<24}{'connect-per-call':>18}{'persistent':>14}{'speedup':>10}")
+    for name in rows["persistent"]:
+        before = rows["connect-per-call"][name]
+        after = rows["persistent"][name]
+        print(f"{name:<24}{before:>18.1f}{after:>14.1f}{before / after:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import asyncio
+import statistics
+import sys
+import time
+import aiohttp
+from aiogram import Bot, Dispatcher
+from webhook import create_webhook_app, start_webhook_server
+
+# Локальный замер режима webhook: синтетические апдейты отправляются POST-запросами
+# на поднятый сервер, задержка считается от отправки до завершения хендлера.
+# Хендлер имитирует работу паузой в handler_ms, так видно параллельную обработку.
+# Запуск: python3 bench_webhook.py [updates] [concurrency] [handler_ms]
+
+HOST = "127.0.0.1"
+PORT = 8089
+PATH = "/webhook"
+SECRET = "bench-secret"
+
+def make_update(update_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+            "text": f"bench {update_id}",
+        },
+    }
+
+async def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    handler_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    sent_at = {}
+    latencies = []
+    done = asyncio.Event()
+
+    dp = Dispatcher()
+
+    @dp.message()
+    async def handle(message):
+        await asyncio.sleep(handler_ms / 1000)
+        latencies.append(time.perf_counter() - sent_at[message.message_id])
+        if len(latencies) == updates:
+            done.set()
+
+    bot = Bot(token="123456:bench")
+    runner = await start_webhook_server(create_webhook_app(dp, bot, SECRET, PATH), HOST, PORT)
+    url = f"http://{HOST}:{PORT}{PATH}"
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json=make_update(0)) as response:
+                assert response.status == 401, f"запрос без секрета принят: {response.status}"
+
+            async def post(update_id):
+                async with semaphore:
+                    sent_at[update_id] = time.perf_counter()
+                    async with session.post(url, json=make_update(update_id), headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as response:
+                        assert response.status == 200, response.status
+
+            start = time.perf_counter()
+            await asyncio.gather(*(post(i) for i in range(1, updates + 1)))
+            await asyncio.wait_for(done.wait(), 60)
+            elapsed = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+
+    latencies.sort()
+    print(f"updates={updates} concurrency={concurrency} handler_ms={handler_ms}")
+    print(f"пропускная способность: {updates / elapsed:.0f} апдейтов/с")
+    print(f"задержка, мс: p50={statistics.median(latencies) * 1000:.1f} "
+          f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} max={latencies[-1] * 1000:.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,24 +1,95 @@
 import asyncio
 import logging
+import signal
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import BOT_TOKEN
-from database import Database
+from config import BOT_TOKEN, USE_WEBHOOK, WORKERS
+from database import AsyncDatabase
+from fragment import start_http_client, close_http_client, wallet_manager
+from assistant import close_groq_client
 from handlers import register_all_handlers
+from middlewares import register_middlewares
+from purchases import PurchaseQueue
+from broadcast import BroadcastEngine
+from confirmations import ConfirmationTracker
+from storage import create_storage
+from webhook import run_webhook
+from workers import Supervisor, serve_updates
 
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
+    format="%(asctime)s - %(processName)s - %(levelname)s - %(message)s"
 )
 
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
-db = Database()
+dp = Dispatcher(storage=create_storage())
+db = AsyncDatabase()
+purchase_queue = PurchaseQueue(db, bot)
+broadcast_engine = BroadcastEngine(db, bot)
+confirmation_tracker = ConfirmationTracker(db, bot)
+
+async def start_services(owner=True):
+    register_middlewares(dp, db)
+    register_all_handlers(dp, db, bot, purchase_queue, broadcast_engine)
+    start_http_client()
+    try:
+        wallet_manager.refresh()
+    except Exception as e:
+        logging.error(f"Не удалось загрузить TON кошелек: {e}")
+    if owner:
+        # Кошелек общий для всех процессов: переводы из нескольких процессов столкнулись бы на seqno,
+        # поэтому очередь покупок и отслеживание подтверждений работают только в одном из них.
+        # Там же выполняются рассылки, чтобы общий лимит Telegram соблюдался одним TokenBucket
+        await purchase_queue.start()
+        await confirmation_tracker.start()
+        await broadcast_engine.start()
+
+async def stop_services():
+    await confirmation_tracker.stop()
+    await broadcast_engine.stop()
+    await purchase_queue.stop()
+    await close_http_client()
+    await close_groq_client()
+    db.close()
 
 async def main():
-    register_all_handlers(dp, db, bot)
+    if WORKERS > 1:
+        # Супервизор сам апдейты не обрабатывает, хендлеры нужны только для списка allowed_updates
+        register_all_handlers(dp, db, bot, purchase_queue, broadcast_engine)
+        try:
+            await Supervisor(dp, bot, worker_main).run()
+        finally:
+            await bot.session.close()
+            db.close()
+        return
+    await start_services()
     logging.info("Бот запущен")
-    await dp.start_polling(bot)
+    try:
+        if USE_WEBHOOK:
+            await run_webhook(dp, bot)
+        else:
+            # getUpdates не работает, пока установлен webhook от прошлого запуска
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await stop_services()
+
+async def run_worker(number, updates):
+    await db.enable_shared_cache()
+    # Кошельком и рассылками владеет воркер 0, в том числе после перезапуска: его заказы в 'processing'
+    # помечаются прерванными, а незавершенные рассылки продолжаются
+    await start_services(owner=number == 0)
+    logging.info(f"Воркер {number} запущен")
+    try:
+        await serve_updates(dp, bot, db, updates)
+    finally:
+        await stop_services()
+        await bot.session.close()
+
+def worker_main(number, updates):
+    # Процесс-воркер запускается через spawn и получает свои bot, dp и db при импорте модуля.
+    # Ctrl+C обрабатывает супервизор: он дает воркерам дообработать очередь и завершиться
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(number, updates))
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+import config
+from handlers import get_admin_keyboard
+
+class TokenBucket:
+    # Общий лимит Telegram на исходящие сообщения; при 429 весь поток ставится на паузу
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class BroadcastEngine:
+    # Получатели читаются из базы пачками по user_id, прогресс сохраняется после каждой пачки,
+    # поэтому прерванная рассылка продолжается с места остановки (повторно может уйти максимум одна пачка).
+    # Каждому чату уходит одно сообщение, так что лимит на чат соблюдается сам собой, остается общий лимит.
+    # Рассылки выполняет один процесс-владелец: при нескольких воркерах у каждого был бы свой TokenBucket
+    # и общий лимит превышался бы. Остальные процессы только создают запись, владелец подхватывает ее из базы.
+    def __init__(self, db, bot, poll_interval=None):
+        self.db = db
+        self.bot = bot
+        self.bucket = TokenBucket(config.BROADCAST_RATE)
+        self.poll_interval = poll_interval or config.BROADCAST_POLL_INTERVAL
+        self.wakeup = asyncio.Event()
+        self.watcher = None
+        self.tasks = {}
+
+    async def create(self, admin_id, text):
+        total = await self.db.count_broadcast_recipients()
+        status_msg = await self.bot.send_message(admin_id, f"📤 Рассылка: 0/{total}")
+        broadcast_id = await self.db.create_broadcast(admin_id, text, status_msg.message_id)
+        self.wakeup.set()
+        return broadcast_id
+
+    async def start(self):
+        # Незавершенные рассылки (в том числе прерванные прошлым запуском владельца) подхватываются первой проверкой
+        self.watcher = asyncio.create_task(self.watch())
+
+    async def watch(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                for broadcast_id in await self.db.get_running_broadcasts():
+                    if broadcast_id not in self.tasks:
+                        logging.info(f"Запускаю рассылку #{broadcast_id}")
+                        self.launch(broadcast_id)
+            except Exception as e:
+                logging.error(f"Рассылки: ошибка чтения из базы: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        if self.watcher:
+            self.watcher.cancel()
+            await asyncio.gather(self.watcher, return_exceptions=True)
+            self.watcher = None
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = {}
+
+    def launch(self, broadcast_id):
+        task = asyncio.create_task(self.run(broadcast_id))
+        self.tasks[broadcast_id] = task
+        task.add_done_callback(lambda t: self.tasks.pop(broadcast_id, None))
+
+    async def run(self, broadcast_id):
+        _, admin_id, text, status_message_id, last_user_id, sent, failed, blocked = await self.db.get_broadcast(broadcast_id)
+        total = sent + failed + blocked + await self.db.count_broadcast_recipients(last_user_id)
+        semaphore = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+        while True:
+            user_ids = await self.db.get_broadcast_recipients(last_user_id, config.BROADCAST_BATCH)
+            if not user_ids:
+                break
+            results = await asyncio.gather(*(self.deliver(user_id, text, semaphore) for user_id in user_ids))
+            sent += results.count("sent")
+            failed += results.count("failed")
+            blocked += results.count("blocked")
+            last_user_id = user_ids[-1]
+            await self.db.update_broadcast_progress(broadcast_id, last_user_id, sent, failed, blocked)
+            try:
+                await self.bot.edit_message_text(f"📤 Рассылка: {sent + failed + blocked}/{total}", chat_id=admin_id, message_id=status_message_id)
+            except:
+                pass
+        await self.db.finish_broadcast(broadcast_id)
+        try:
+            await self.bot.delete_message(admin_id, status_message_id)
+        except:
+            pass
+        try:
+            await self.bot.send_message(admin_id, f"✅ Рассылка завершена!\n\nОтправлено: {sent}\nОшибок: {failed}\nЗаблокировали бота: {blocked}", reply_markup=get_admin_keyboard())
+        except Exception as e:
+            logging.error(f"Не удалось отправить итог рассылки #{broadcast_id}: {e}")
+
+    async def deliver(self, user_id, text, semaphore):
+        async with semaphore:
+            for attempt in range(config.BROADCAST_RETRIES):
+                await self.bucket.acquire()
+                try:
+                    await self.bot.send_message(user_id, text)
+                    return "sent"
+                except TelegramRetryAfter as e:
+                    logging.warning(f"Рассылка: лимит Telegram, пауза {e.retry_after} с")
+                    self.bucket.pause(e.retry_after)
+                except TelegramForbiddenError:
+                    await self.db.set_bot_blocked(user_id)
+                    return "blocked"
+                except Exception:
+                    return "failed"
+            return "failed"
@@ -0,0 +1,51 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+class TTLCache:
+    # LRU кэш с ограничением по размеру и временем жизни записей, безопасен для нескольких потоков
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.data.pop(key, None)
+            return item[1] if item is not None else default
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self.data)
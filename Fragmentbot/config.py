@@ -37,6 +37,58 @@ FRAGMENT_ADDRES = config.get("FRAGMENT_ADDRES", os.getenv("FRAGMENT_ADDRES", "")
 ADMIN_IDS_STR = config.get("ADMIN_IDS", os.getenv("ADMIN_IDS", ""))
 ADMIN_IDS = [int(x) for x in ADMIN_IDS_STR.split(",") if x]
 
+HTTP2 = str(config.get("HTTP2", os.getenv("HTTP2", "0"))).lower() in ("1", "true", "yes")
+HTTP_TIMEOUT = float(config.get("HTTP_TIMEOUT", os.getenv("HTTP_TIMEOUT", "15")))
+HTTP_CONNECT_TIMEOUT = float(config.get("HTTP_CONNECT_TIMEOUT", os.getenv("HTTP_CONNECT_TIMEOUT", "5")))
+HTTP_MAX_CONNECTIONS = int(config.get("HTTP_MAX_CONNECTIONS", os.getenv("HTTP_MAX_CONNECTIONS", "20")))
+
+RECIPIENT_CACHE_SIZE = int(config.get("RECIPIENT_CACHE_SIZE", os.getenv("RECIPIENT_CACHE_SIZE", "10000")))
+RECIPIENT_CACHE_TTL = float(config.get("RECIPIENT_CACHE_TTL", os.getenv("RECIPIENT_CACHE_TTL", "600")))
+RECIPIENT_CACHE_NEGATIVE_TTL = float(config.get("RECIPIENT_CACHE_NEGATIVE_TTL", os.getenv("RECIPIENT_CACHE_NEGATIVE_TTL", "60")))
+
+PURCHASE_WORKERS = int(config.get("PURCHASE_WORKERS", os.getenv("PURCHASE_WORKERS", "4")))
+PURCHASE_POLL_INTERVAL = float(config.get("PURCHASE_POLL_INTERVAL", os.getenv("PURCHASE_POLL_INTERVAL", "5")))
+PURCHASE_STOP_TIMEOUT = float(config.get("PURCHASE_STOP_TIMEOUT", os.getenv("PURCHASE_STOP_TIMEOUT", "90")))
+ORDER_PREFETCH_TTL = float(config.get("ORDER_PREFETCH_TTL", os.getenv("ORDER_PREFETCH_TTL", "120")))
+
+FRAGMENT_DEADLINE = float(config.get("FRAGMENT_DEADLINE", os.getenv("FRAGMENT_DEADLINE", "10")))
+FRAGMENT_RETRIES = int(config.get("FRAGMENT_RETRIES", os.getenv("FRAGMENT_RETRIES", "2")))
+TON_DEADLINE = float(config.get("TON_DEADLINE", os.getenv("TON_DEADLINE", "60")))
+CONFIRM_INTERVAL = float(config.get("CONFIRM_INTERVAL", os.getenv("CONFIRM_INTERVAL", "10")))
+CONFIRM_TIMEOUT = float(config.get("CONFIRM_TIMEOUT", os.getenv("CONFIRM_TIMEOUT", "600")))
+BREAKER_FAILURES = int(config.get("BREAKER_FAILURES", os.getenv("BREAKER_FAILURES", "5")))
+BREAKER_RESET = float(config.get("BREAKER_RESET", os.getenv("BREAKER_RESET", "30")))
+
+TON_BATCH_WINDOW = float(config.get("TON_BATCH_WINDOW", os.getenv("TON_BATCH_WINDOW", "0.5")))
+TON_BATCH_SIZE = int(config.get("TON_BATCH_SIZE", os.getenv("TON_BATCH_SIZE", "255")))
+TON_MESSAGE_TTL = float(config.get("TON_MESSAGE_TTL", os.getenv("TON_MESSAGE_TTL", "60")))
+PAYLOAD_CAPTURE_FILE = config.get("PAYLOAD_CAPTURE_FILE", os.getenv("PAYLOAD_CAPTURE_FILE", ""))
+
+BROADCAST_RATE = float(config.get("BROADCAST_RATE", os.getenv("BROADCAST_RATE", "25")))
+BROADCAST_CONCURRENCY = int(config.get("BROADCAST_CONCURRENCY", os.getenv("BROADCAST_CONCURRENCY", "20")))
+BROADCAST_BATCH = int(config.get("BROADCAST_BATCH", os.getenv("BROADCAST_BATCH", "100")))
+BROADCAST_RETRIES = int(config.get("BROADCAST_RETRIES", os.getenv("BROADCAST_RETRIES", "3")))
+BROADCAST_POLL_INTERVAL = float(config.get("BROADCAST_POLL_INTERVAL", os.getenv("BROADCAST_POLL_INTERVAL", "5")))
+
+USE_WEBHOOK = str(config.get("USE_WEBHOOK", os.getenv("USE_WEBHOOK", "0"))).lower() in ("1", "true", "yes")
+WEBHOOK_URL = config.get("WEBHOOK_URL", os.getenv("WEBHOOK_URL", ""))
+WEBHOOK_PATH = config.get("WEBHOOK_PATH", os.getenv("WEBHOOK_PATH", "/webhook"))
+WEBHOOK_SECRET = config.get("WEBHOOK_SECRET", os.getenv("WEBHOOK_SECRET", ""))
+WEBHOOK_HOST = config.get("WEBHOOK_HOST", os.getenv("WEBHOOK_HOST", "0.0.0.0"))
+WEBHOOK_PORT = int(config.get("WEBHOOK_PORT", os.getenv("WEBHOOK_PORT", "8080")))
+
+FSM_STORAGE = config.get("FSM_STORAGE", os.getenv("FSM_STORAGE", "sqlite"))
+FSM_STORAGE_PATH = config.get("FSM_STORAGE_PATH", os.getenv("FSM_STORAGE_PATH", "fsm_storage.db"))
+FSM_REDIS_URL = config.get("FSM_REDIS_URL", os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0"))
+
+WORKERS = int(config.get("WORKERS", os.getenv("WORKERS", "1")))
+WORKER_QUEUE_SIZE = int(config.get("WORKER_QUEUE_SIZE", os.getenv("WORKER_QUEUE_SIZE", "1000")))
+CACHE_SYNC_INTERVAL = float(config.get("CACHE_SYNC_INTERVAL", os.getenv("CACHE_SYNC_INTERVAL", "1")))
+
+AI_CACHE_SIZE = int(config.get("AI_CACHE_SIZE", os.getenv("AI_CACHE_SIZE", "1000")))
+AI_CACHE_TTL = float(config.get("AI_CACHE_TTL", os.getenv("AI_CACHE_TTL", "3600")))
+AI_EDIT_INTERVAL = float(config.get("AI_EDIT_INTERVAL", os.getenv("AI_EDIT_INTERVAL", "1")))
+
 SHOP_NAME = "AU Stars"
 DAILY_BONUS_AMOUNT = 10
 STAR_PRICE_RUB = 2.5
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+import config
+from fragment import fetch_wallet_seqno, fetch_wallet_transactions, message_key, normalized_message_hash, out_message_keys
+from handlers import get_back_to_menu_keyboard
+
+# Запас по времени: часы сервера и блокчейна могут расходиться
+CLOCK_MARGIN = 120
+
+def transaction_succeeded(transaction):
+    # При send_mode=3 сообщение, на которое не хватило баланса, пропускается, а фаза действий остается успешной
+    action_phase = transaction.get("action_phase") or {}
+    return (
+        transaction.get("success", False)
+        and not transaction.get("aborted", False)
+        and action_phase.get("success", True)
+        and action_phase.get("skipped_actions", 0) == 0
+    )
+
+def take_message(sent_keys, ton_destination, ton_amount, body_hash):
+    # Каждое отправленное сообщение засчитывается одной покупке.
+    # Если tonapi не отдал тело сообщения, сравниваются только адрес и сумма
+    key = message_key(ton_destination, ton_amount, body_hash)
+    for candidate in (key, key[:2] + (None,)):
+        if sent_keys[candidate] > 0:
+            sent_keys[candidate] -= 1
+            return True
+    return False
+
+class ConfirmationTracker:
+    # Покупки в статусе 'sent' ждут появления перевода в блокчейне. Раз в CONFIRM_INTERVAL
+    # история кошелька запрашивается одним пакетным запросом на все ожидающие покупки:
+    # найденный успешный перевод завершает покупку, неуспешный - возвращает средства. Одна транзакция
+    # несет пачку сообщений, поэтому покупка завершается, только если среди отправленных есть ее сообщение.
+    # Ненайденный перевод возвращается, только если история за время отправки полная и сообщение
+    # уже не может попасть в сеть: seqno кошелька ушел дальше или истек valid_until
+    def __init__(self, db, bot, interval=None, timeout=None):
+        self.db = db
+        self.bot = bot
+        self.interval = interval or config.CONFIRM_INTERVAL
+        self.timeout = timeout or config.CONFIRM_TIMEOUT
+        self.task = None
+        self.missing = set()
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+        logging.info("Отслеживание подтверждений TON запущено")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logging.error(f"Ошибка проверки подтверждений TON: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def check(self):
+        purchases = await self.db.get_sent_star_purchases()
+        if not purchases:
+            self.missing = set()
+            return
+        sent_times = {purchase[0]: datetime.fromisoformat(str(purchase[6])).timestamp() for purchase in purchases}
+        # seqno читается до истории: если он уже сдвинулся, транзакция с этим seqno попадет в историю, полученную после
+        wallet_seqno = await fetch_wallet_seqno()
+        transactions, covered_from = await fetch_wallet_transactions(min(sent_times.values()) - CLOCK_MARGIN)
+        if covered_from:
+            logging.warning(f"История кошелька получена не полностью, покупки до {datetime.fromtimestamp(covered_from)} не считаются ненайденными")
+        # tx_hash от tonutils - нормализованный хэш внешнего сообщения; обычные хэши оставлены для старых записей
+        by_hash = {}
+        for transaction in transactions:
+            in_msg = transaction.get("in_msg") or {}
+            for tx_hash in (transaction.get("hash"), in_msg.get("hash"), normalized_message_hash(in_msg)):
+                if tx_hash:
+                    by_hash[tx_hash.lower()] = transaction
+        now = time.time()
+        missing = set()
+        sent_keys = {}
+        for purchase_id, user_id, recipient, stars, total_cost, tx_hash, _, seqno, valid_until, ton_destination, ton_amount, body_hash in purchases:
+            transaction = by_hash.get((tx_hash or "").lower())
+            if transaction is not None:
+                if ton_destination is None:
+                    # Старая запись без своего сообщения: засчитывается только транзакция без пропусков
+                    confirmed = transaction_succeeded(transaction)
+                else:
+                    if transaction["hash"] not in sent_keys:
+                        sent_keys[transaction["hash"]] = out_message_keys(transaction)
+                    confirmed = take_message(sent_keys[transaction["hash"]], ton_destination, ton_amount, body_hash)
+                await self.settle(purchase_id, user_id, recipient, stars, total_cost, transaction["hash"], confirmed)
+            elif seqno is None or valid_until is None:
+                # Отправлена до того, как seqno стал сохраняться: доказать, что перевод не пройдет, нечем
+                if now - sent_times[purchase_id] > self.timeout:
+                    logging.error(f"Покупка #{purchase_id}: перевод {tx_hash} не найден за {self.timeout:g} с, требуется ручная проверка")
+                    await self.db.update_star_purchase(purchase_id, tx_hash, "interrupted")
+                    await self.notify(user_id, "⏳ Перевод задерживается. Мы проверим его вручную и сообщим результат.", get_back_to_menu_keyboard())
+            elif sent_times[purchase_id] - CLOCK_MARGIN >= covered_from and (wallet_seqno > seqno or now > valid_until + CLOCK_MARGIN):
+                # Индексатор tonapi может отставать от seqno, поэтому перевод считается потерянным,
+                # только если его нет и во второй проверке подряд
+                if purchase_id not in self.missing:
+                    missing.add(purchase_id)
+                    continue
+                logging.warning(f"Покупка #{purchase_id}: перевод {tx_hash} (seqno {seqno}) не попал в сеть, seqno кошелька {wallet_seqno}")
+                await self.settle(purchase_id, user_id, recipient, stars, total_cost, tx_hash, False)
+        self.missing = missing
+
+    async def settle(self, purchase_id, user_id, recipient, stars, total_cost, tx_hash, confirmed):
+        if not await self.db.settle_star_purchase(purchase_id, user_id, total_cost, confirmed, f"Покупка {stars} звезд"):
+            return
+        if confirmed:
+            logging.info(f"Покупка #{purchase_id} подтверждена в сети: {tx_hash}")
+            await self.notify(user_id, f"✅ Успешно!\n\n⭐️ Отправлено: {stars}\n👤 Получатель: {recipient}\n💰 Списано: {total_cost:.2f} ₽\n\n🔗 https://tonviewer.com/transaction/{tx_hash}\n\nСделано с 💙", InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💙 Главное меню", callback_data="main_menu")]]))
+        else:
+            logging.error(f"Покупка #{purchase_id}: перевод {tx_hash} не прошел, средства возвращены")
+            await self.notify(user_id, "❌ Перевод не прошел в сети TON. Средства возвращены на баланс.", get_back_to_menu_keyboard())
+
+    async def notify(self, user_id, text, reply_markup):
+        try:
+            await self.bot.send_message(user_id, text, reply_markup=reply_markup)
+        except Exception as e:
+            logging.error(f"Не удалось уведомить пользователя {user_id}: {e}")
@@ -1,322 +1,663 @@
+import asyncio
+import logging
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import partial
+from itertools import groupby
+from cache import MISSING, TTLCache
+
+CACHE_SIZE_KB = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+CACHED_STATEMENTS = 256
+USER_CACHE_SIZE = 50_000
+USER_CACHE_TTL = 600
+# Явный список колонок users: новые колонки из миграций не меняют форму строки, которую разбирают обработчики
+USER_FIELDS = ("user_id", "username", "first_name", "last_name", "balance", "is_blocked", "is_welcomed", "created_at", "last_daily_bonus")
+USER_COLUMNS = ", ".join(USER_FIELDS)
+WRITE_BEHIND_INTERVAL = 0.05
+WRITE_BEHIND_BATCH = 500
+WRITE_BEHIND_MAX = 10_000
+
+TRANSACTION_INSERT_SQL = "INSERT INTO transactions (user_id, type, amount, description) VALUES (?, ?, ?, ?)"
+TICKET_MESSAGE_INSERT_SQL = "INSERT INTO ticket_messages (ticket_id, user_id, message) VALUES (?, ?, ?)"
+PROFILE_UPDATE_SQL = "UPDATE users SET username = ?, first_name = ?, last_name = ?, is_bot_blocked = 0 WHERE user_id = ?"
+INVALIDATION_INSERT_SQL = "INSERT INTO cache_invalidations (kind, key) VALUES (?, ?)"
+INVALIDATION_KEEP = "-1 hour"
+INVALIDATION_PRUNE_EVERY = 600
+
+# Миграции схемы: версия хранится в PRAGMA user_version, каждая миграция
+# применяется один раз в отдельной транзакции. Новые миграции только добавлять в конец.
+MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_type_created ON transactions(user_id, type, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_star_purchases_user_created ON star_purchases(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_star_purchases_status ON star_purchases(status)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_user_status ON tickets(user_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_status_created ON tickets(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket_created ON ticket_messages(ticket_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_is_blocked ON users(is_blocked)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_promo_codes_is_used ON promo_codes(is_used)",
+    ],
+    [
+        "ALTER TABLE star_purchases ADD COLUMN recipient_id TEXT",
+        "ALTER TABLE star_purchases ADD COLUMN updated_at TIMESTAMP",
+    ],
+    [
+        "ALTER TABLE users ADD COLUMN is_bot_blocked BOOLEAN DEFAULT 0",
+        """
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                status TEXT DEFAULT 'running',
+                status_message_id INTEGER,
+                last_user_id INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """,
+    ],
+    [
+        # Счетчики для экрана статистики поддерживаются триггерами при каждой записи,
+        # поэтому get_stats читает одну строку вместо агрегатов по всем таблицам
+        """
+            CREATE TABLE IF NOT EXISTS stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_users INTEGER DEFAULT 0,
+                blocked_users INTEGER DEFAULT 0,
+                total_codes INTEGER DEFAULT 0,
+                used_codes INTEGER DEFAULT 0,
+                completed_purchases INTEGER DEFAULT 0,
+                total_stars INTEGER DEFAULT 0,
+                total_balance REAL DEFAULT 0
+            )
+        """,
+        """
+            INSERT OR REPLACE INTO stats (id, total_users, blocked_users, total_codes, used_codes, completed_purchases, total_stars, total_balance)
+            SELECT 1,
+                (SELECT COUNT(*) FROM users),
+                (SELECT COUNT(*) FROM users WHERE is_blocked = 1),
+                (SELECT COUNT(*) FROM promo_codes),
+                (SELECT COUNT(*) FROM promo_codes WHERE is_used = 1),
+                (SELECT COUNT(*) FROM star_purchases WHERE status = 'completed'),
+                (SELECT COALESCE(SUM(stars_amount), 0) FROM star_purchases WHERE status = 'completed'),
+                (SELECT COALESCE(SUM(balance), 0) FROM users)
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+                UPDATE stats SET
+                    total_users = total_users + 1,
+                    blocked_users = blocked_users + (NEW.is_blocked = 1),
+                    total_balance = total_balance + COALESCE(NEW.balance, 0)
+                WHERE id = 1;
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS stats_users_update AFTER UPDATE OF balance, is_blocked ON users
+            WHEN NEW.balance IS NOT OLD.balance OR NEW.is_blocked IS NOT OLD.is_blocked BEGIN
+                UPDATE stats SET
+                    blocked_users = blocked_users + (NEW.is_blocked = 1) - (OLD.is_blocked = 1),
+                    total_balance = total_balance + COALESCE(NEW.balance, 0) - COALESCE(OLD.balance, 0)
+                WHERE id = 1;
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+                UPDATE stats SET
+                    total_users = total_users - 1,
+                    blocked_users = blocked_users - (OLD.is_blocked = 1),
+                    total_balance = total_balance - COALESCE(OLD.balance, 0)
+                WHERE id = 1;
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS stats_promo_codes_insert AFTER INSERT ON promo_codes BEGIN
+                UPDATE stats SET
+                    total_codes = total_codes + 1,
+                    used_codes = used_codes + (NEW.is_used = 1)
+                WHERE id = 1;
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS stats_promo_codes_update AFTER UPDATE OF is_used ON promo_codes
+            WHEN NEW.is_used IS NOT OLD.is_used BEGIN
+                UPDATE stats SET used_codes = used_codes + (NEW.is_used = 1) - (OLD.is_used = 1) WHERE id = 1;
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS stats_promo_codes_delete AFTER DELETE ON promo_codes BEGIN
+                UPDATE stats SET
+                    total_codes = total_codes - 1,
+                    used_codes = used_codes - (OLD.is_used = 1)
+                WHERE id = 1;
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS stats_star_purchases_insert AFTER INSERT ON star_purchases
+            WHEN NEW.status = 'completed' BEGIN
+                UPDATE stats SET
+                    completed_purchases = completed_purchases + 1,
+                    total_stars = total_stars + NEW.stars_amount
+                WHERE id = 1;
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS stats_star_purchases_update AFTER UPDATE OF status, stars_amount ON star_purchases
+            WHEN OLD.status = 'completed' OR NEW.status = 'completed' BEGIN
+                UPDATE stats SET
+                    completed_purchases = completed_purchases + (NEW.status = 'completed') - (OLD.status = 'completed'),
+                    total_stars = total_stars
+                        + CASE WHEN NEW.status = 'completed' THEN NEW.stars_amount ELSE 0 END
+                        - CASE WHEN OLD.status = 'completed' THEN OLD.stars_amount ELSE 0 END
+                WHERE id = 1;
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS stats_star_purchases_delete AFTER DELETE ON star_purchases
+            WHEN OLD.status = 'completed' BEGIN
+                UPDATE stats SET
+                    completed_purchases = completed_purchases - 1,
+                    total_stars = total_stars - OLD.stars_amount
+                WHERE id = 1;
+            END
+        """,
+    ],
+    [
+        # Журнал изменений для процессов-воркеров: каждый держит свои кэши в памяти
+        # и по этому журналу сбрасывает то, что изменили другие процессы
+        """
+            CREATE TABLE IF NOT EXISTS cache_invalidations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                key INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_cache_invalidations_created ON cache_invalidations(created_at)",
+    ],
+    [
+        "ALTER TABLE star_purchases ADD COLUMN prefetched_order TEXT",
+    ],
+    [
+        # seqno и valid_until внешнего сообщения: по ним видно, что перевод уже не попадет в сеть
+        "ALTER TABLE star_purchases ADD COLUMN seqno INTEGER",
+        "ALTER TABLE star_purchases ADD COLUMN valid_until INTEGER",
+    ],
+    [
+        # Сообщение покупки внутри пачки: в одной транзакции кошелька их может быть много,
+        # и при send_mode=3 часть из них может быть пропущена
+        "ALTER TABLE star_purchases ADD COLUMN ton_destination TEXT",
+        "ALTER TABLE star_purchases ADD COLUMN ton_amount INTEGER",
+        "ALTER TABLE star_purchases ADD COLUMN body_hash TEXT",
+    ],
+]
+
+def in_memory(method):
+    # Метод отвечает из памяти процесса без запросов к SQLite:
+    # AsyncDatabase вызывает его прямо в event loop, без перехода в поток БД
+    method.in_memory = True
+    return method
+
+def memory_first(lookup):
+    # lookup(self, *args) пробует ответить из памяти и возвращает MISSING, если не может;
+    # AsyncDatabase вызывает его в event loop и идет в поток БД только при промахе
+    def decorate(method):
+        method.memory_lookup = lookup
+        return method
+    return decorate
+
+def cached_user_field(convert, default):
+    def lookup(self, user_id):
+        user = self.users_cache.get(user_id)
+        if user is MISSING:
+            return MISSING
+        return convert(user) if user else default
+    return lookup
+
+def daily_bonus_available(user):
+    last_bonus = user[8]
+    if not last_bonus:
+        return True
+    return datetime.now() - datetime.fromisoformat(last_bonus) >= timedelta(days=1)
+
+class WriteBehindQueue:
+    # Копит низкоприоритетные записи (журнал операций, сообщения тикетов, профили) и пишет их
+    # одной транзакцией раз в interval секунд или по набору batch_size строк.
+    # Очередь ограничена max_size: при переполнении вызывающий сам сбрасывает ее на диск.
+    # При аварийном завершении процесса теряются записи не более чем за один интервал.
+    def __init__(self, db, interval=WRITE_BEHIND_INTERVAL, batch_size=WRITE_BEHIND_BATCH, max_size=WRITE_BEHIND_MAX):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self.items = []
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+    
+    def put(self, sql, params):
+        with self.cond:
+            self.items.append((sql, params))
+            size = len(self.items)
+            if size >= self.batch_size:
+                self.cond.notify()
+        if size >= self.max_size:
+            self.flush()
+    
+    def flush(self):
+        # Забор и запись под блокировкой БД: пачки ложатся на диск в порядке постановки
+        with self.db.lock:
+            with self.cond:
+                items, self.items = self.items, []
+            if not items:
+                return
+            with self.db.transaction(), self.db.get_cursor() as cursor:
+                for sql, group in groupby(items, key=lambda item: item[0]):
+                    cursor.executemany(sql, [params for _, params in group])
+    
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.closed and len(self.items) < self.batch_size:
+                    self.cond.wait(self.interval)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка фоновой записи в базу данных: {e}")
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.flush()
 
 class Database:
     def __init__(self, db_name="shop_bot.db"):
         self.db_name = db_name
+        self.conn = None
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.settings = {}
+        self.menu_buttons = []
+        self.menu_version = 0
+        self.users_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+        self.blocked_users = set()
+        self.write_behind = WriteBehindQueue(self)
+        self.shared = False
+        self.invalidation_id = 0
+        self.sync_count = 0
         self.init_db()
+        self.load_settings()
+        self.load_menu_buttons()
+        self.load_blocked_users()
     
     def get_connection(self):
-        return sqlite3.connect(self.db_name)
+        if self.conn is None:
+            conn = sqlite3.connect(self.db_name, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+            conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self.conn = conn
+        return self.conn
     
-    def init_db(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                balance REAL DEFAULT 0,
-                is_blocked BOOLEAN DEFAULT 0,
-                is_welcomed BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_daily_bonus TIMESTAMP
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS promo_codes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT UNIQUE NOT NULL,
-                balance_amount REAL NOT NULL,
-                is_used BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                used_at TIMESTAMP,
-                used_by_user_id INTEGER,
-                FOREIGN KEY (used_by_user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                type TEXT NOT NULL,
-                amount REAL NOT NULL,
-                description TEXT,
-                status TEXT DEFAULT 'completed',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS star_purchases (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                recipient_username TEXT NOT NULL,
-                stars_amount INTEGER NOT NULL,
-                balance_spent REAL NOT NULL,
-                tx_hash TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS tickets (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                subject TEXT NOT NULL,
-                status TEXT DEFAULT 'open',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                closed_at TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS ticket_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ticket_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                message TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (ticket_id) REFERENCES tickets(id),
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS menu_buttons (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                button_text TEXT NOT NULL,
-                button_url TEXT,
-                button_order INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT 1
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+    @contextmanager
+    def get_cursor(self):
+        # Вложенные вызовы (внутри transaction) не коммитят: фиксирует только внешний уровень
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            self.depth += 1
+            try:
+                yield cursor
+                if self.depth == 1:
+                    conn.commit()
+            except Exception:
+                if self.depth == 1:
+                    conn.rollback()
+                raise
+            finally:
+                self.depth -= 1
+                cursor.close()
     
-    def add_user(self, user_id, username, first_name, last_name):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+    @contextmanager
+    def transaction(self):
+        # Вложенная транзакция присоединяется к внешней
+        with self.get_cursor() as cursor:
+            if self.depth == 1:
+                cursor.execute("BEGIN IMMEDIATE")
+            yield self
+    
+    def atomic(self, work):
+        # Выполняет work(db) одной транзакцией с одним коммитом; при исключении все откатывается
+        with self.transaction():
+            return work(self)
+    
+    def write_later(self, sql, params):
+        # Вне транзакции низкоприоритетная запись уходит в write-behind очередь,
+        # внутри транзакции выполняется сразу, чтобы остаться атомарной с остальными
+        if self.depth == 0:
+            self.write_behind.put(sql, params)
+            return
+        with self.get_cursor() as cursor:
+            cursor.execute(sql, params)
+    
+    def close(self):
+        self.write_behind.close()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+    
+    def init_db(self):
+        with self.get_cursor() as cursor:
             cursor.execute("""
-                INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, username, first_name, last_name))
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    balance REAL DEFAULT 0,
+                    is_blocked BOOLEAN DEFAULT 0,
+                    is_welcomed BOOLEAN DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_daily_bonus TIMESTAMP
+                )
+            """)
+            
             cursor.execute("""
-                UPDATE users 
-                SET username = ?, first_name = ?, last_name = ?
-                WHERE user_id = ?
-            """, (username, first_name, last_name, user_id))
-            conn.commit()
-        finally:
-            conn.close()
+                CREATE TABLE IF NOT EXISTS promo_codes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    code TEXT UNIQUE NOT NULL,
+                    balance_amount REAL NOT NULL,
+                    is_used BOOLEAN DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    used_at TIMESTAMP,
+                    used_by_user_id INTEGER,
+                    FOREIGN KEY (used_by_user_id) REFERENCES users(user_id)
+                )
+            """)
+            
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS transactions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    type TEXT NOT NULL,
+                    amount REAL NOT NULL,
+                    description TEXT,
+                    status TEXT DEFAULT 'completed',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            """)
+            
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS star_purchases (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    recipient_username TEXT NOT NULL,
+                    stars_amount INTEGER NOT NULL,
+                    balance_spent REAL NOT NULL,
+                    tx_hash TEXT,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            """)
+            
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS tickets (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    subject TEXT NOT NULL,
+                    status TEXT DEFAULT 'open',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    closed_at TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            """)
+            
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ticket_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ticket_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    message TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (ticket_id) REFERENCES tickets(id),
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            """)
+            
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS menu_buttons (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    button_text TEXT NOT NULL,
+                    button_url TEXT,
+                    button_order INTEGER DEFAULT 0,
+                    is_active BOOLEAN DEFAULT 1
+                )
+            """)
+            
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            """)
+        self.migrate()
+    
+    def get_schema_version(self):
+        with self.get_cursor() as cursor:
+            cursor.execute("PRAGMA user_version")
+            return cursor.fetchone()[0]
+    
+    def migrate(self):
+        version = self.get_schema_version()
+        for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+            with self.transaction(), self.get_cursor() as cursor:
+                # Версия перечитывается под блокировкой записи: процессы-воркеры стартуют одновременно
+                if self.get_schema_version() >= number:
+                    continue
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(f"PRAGMA user_version = {number}")
+            logging.info(f"Схема базы данных обновлена до версии {number}")
     
+    def add_user(self, user_id, username, first_name, last_name):
+        changed = False
+        with self.lock:
+            user = self.users_cache.get(user_id, None)
+            if user and user[1:4] != (username, first_name, last_name):
+                user = (user_id, username, first_name, last_name) + tuple(user[4:])
+                self.users_cache.set(user_id, user)
+                changed = True
+        if user:
+            if changed:
+                # Известный пользователь: обновление профиля не срочное, пишется в фоне
+                self.write_later(PROFILE_UPDATE_SQL, (username, first_name, last_name, user_id))
+            return user
+        with self.lock:
+            with self.get_cursor() as cursor:
+                cursor.execute("""
+                    INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
+                    VALUES (?, ?, ?, ?)
+                """, (user_id, username, first_name, last_name))
+                cursor.execute("""
+                    UPDATE users 
+                    SET username = ?, first_name = ?, last_name = ?, is_bot_blocked = 0
+                    WHERE user_id = ?
+                """, (username, first_name, last_name, user_id))
+                cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE user_id = ?", (user_id,))
+                user = cursor.fetchone()
+            self.users_cache.set(user_id, user)
+            return user
+    
+    @memory_first(lambda self, user_id: self.users_cache.get(user_id))
     def get_user(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            return cursor.fetchone()
-        finally:
-            conn.close()
+        with self.lock:
+            user = self.users_cache.get(user_id)
+            if user is not MISSING:
+                return user
+            with self.get_cursor() as cursor:
+                cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE user_id = ?", (user_id,))
+                user = cursor.fetchone()
+            self.users_cache.set(user_id, user)
+            return user
+    
+    def forget_user(self, user_id):
+        with self.lock:
+            self.users_cache.pop(user_id)
+        self.publish("user", user_id)
     
     def set_welcomed(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("UPDATE users SET is_welcomed = 1 WHERE user_id = ?", (user_id,))
-            conn.commit()
-        finally:
-            conn.close()
+            self.forget_user(user_id)
     
+    @memory_first(cached_user_field(lambda user: bool(user[6]), False))
     def is_user_welcomed(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT is_welcomed FROM users WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            return bool(result[0]) if result else False
-        finally:
-            conn.close()
+        user = self.get_user(user_id)
+        return bool(user[6]) if user else False
+    
+    def load_blocked_users(self):
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT user_id FROM users WHERE is_blocked = 1")
+            self.blocked_users = {row[0] for row in cursor.fetchall()}
     
+    @in_memory
     def is_user_blocked(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT is_blocked FROM users WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            return bool(result[0]) if result else False
-        finally:
-            conn.close()
+        return user_id in self.blocked_users
     
     def block_user(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("UPDATE users SET is_blocked = 1 WHERE user_id = ?", (user_id,))
-            conn.commit()
-            return cursor.rowcount > 0
-        finally:
-            conn.close()
+            self.forget_user(user_id)
+            if cursor.rowcount > 0:
+                self.blocked_users = self.blocked_users | {user_id}
+                self.publish("blocked", user_id)
+                return True
+            return False
     
     def unblock_user(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("UPDATE users SET is_blocked = 0 WHERE user_id = ?", (user_id,))
-            conn.commit()
-            return cursor.rowcount > 0
-        finally:
-            conn.close()
+            self.forget_user(user_id)
+            if cursor.rowcount > 0:
+                self.blocked_users = self.blocked_users - {user_id}
+                self.publish("blocked", user_id)
+                return True
+            return False
     
+    @memory_first(cached_user_field(lambda user: float(user[4]), 0))
     def get_balance(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            return float(result[0]) if result else 0
-        finally:
-            conn.close()
+        user = self.get_user(user_id)
+        return float(user[4]) if user else 0
     
     def add_balance(self, user_id, amount):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
-            conn.commit()
-        finally:
-            conn.close()
+            self.forget_user(user_id)
+    
+    def debit_balance(self, user_id, amount):
+        # Списание только при достаточном балансе; проверка и списание в одном UPDATE
+        with self.get_cursor() as cursor:
+            cursor.execute("UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?", (amount, user_id, amount))
+            self.forget_user(user_id)
+            return cursor.rowcount > 0
     
     def subtract_balance(self, user_id, amount):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (amount, user_id))
-            conn.commit()
-        finally:
-            conn.close()
+            self.forget_user(user_id)
     
+    @memory_first(cached_user_field(daily_bonus_available, True))
     def can_claim_daily_bonus(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT last_daily_bonus FROM users WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            if not result or not result[0]:
-                return True
-            last_bonus = datetime.fromisoformat(result[0])
-            return datetime.now() - last_bonus >= timedelta(days=1)
-        finally:
-            conn.close()
+        user = self.get_user(user_id)
+        return daily_bonus_available(user) if user else True
     
     def claim_daily_bonus(self, user_id, amount):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("""
-                UPDATE users 
-                SET balance = balance + ?, last_daily_bonus = ?
-                WHERE user_id = ?
-            """, (amount, datetime.now(), user_id))
-            conn.commit()
-        finally:
-            conn.close()
+        now = datetime.now()
+        with self.transaction():
+            with self.get_cursor() as cursor:
+                cursor.execute("""
+                    UPDATE users 
+                    SET balance = balance + ?, last_daily_bonus = ?
+                    WHERE user_id = ? AND (last_daily_bonus IS NULL OR last_daily_bonus <= ?)
+                """, (amount, now, user_id, now - timedelta(days=1)))
+                self.forget_user(user_id)
+                if cursor.rowcount == 0:
+                    return False
+            self.add_transaction(user_id, "bonus", amount, "Ежедневный бонус")
+            return True
     
     def add_promo_code(self, code, balance_amount):
-        conn = self.get_connection()
-        cursor = conn.cursor()
         try:
-            cursor.execute("INSERT INTO promo_codes (code, balance_amount) VALUES (?, ?)", (code, balance_amount))
-            conn.commit()
+            with self.get_cursor() as cursor:
+                cursor.execute("INSERT INTO promo_codes (code, balance_amount) VALUES (?, ?)", (code, balance_amount))
             return True
         except sqlite3.IntegrityError:
             return False
-        finally:
-            conn.close()
     
     def check_promo_code(self, code):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("SELECT code, balance_amount, is_used FROM promo_codes WHERE code = ?", (code,))
             result = cursor.fetchone()
             if result:
                 return {"code": result[0], "balance_amount": result[1], "is_used": bool(result[2])}
             return None
-        finally:
-            conn.close()
     
     def use_promo_code(self, code, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 UPDATE promo_codes 
                 SET is_used = 1, used_at = ?, used_by_user_id = ?
                 WHERE code = ? AND is_used = 0
             """, (datetime.now(), user_id, code))
-            conn.commit()
             return cursor.rowcount > 0
-        finally:
-            conn.close()
+    
+    def redeem_promo_code(self, code, user_id):
+        with self.transaction():
+            if not self.use_promo_code(code, user_id):
+                return None
+            with self.get_cursor() as cursor:
+                cursor.execute("SELECT balance_amount FROM promo_codes WHERE code = ?", (code,))
+                amount = cursor.fetchone()[0]
+            self.add_balance(user_id, amount)
+            self.add_transaction(user_id, "promo", amount, f"Промокод {code}")
+            return amount
     
     def delete_promo_code(self, code):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("DELETE FROM promo_codes WHERE code = ?", (code,))
-            conn.commit()
             return cursor.rowcount > 0
-        finally:
-            conn.close()
     
     def get_all_promo_codes(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 SELECT code, balance_amount, is_used, created_at, used_at, used_by_user_id 
                 FROM promo_codes ORDER BY created_at DESC
             """)
             return cursor.fetchall()
-        finally:
-            conn.close()
     
     def add_transaction(self, user_id, trans_type, amount, description):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("""
-                INSERT INTO transactions (user_id, type, amount, description)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, trans_type, amount, description))
-            conn.commit()
-            return cursor.lastrowid
-        finally:
-            conn.close()
+        self.write_later(TRANSACTION_INSERT_SQL, (user_id, trans_type, amount, description))
     
     def get_user_transactions(self, user_id, trans_type=None, limit=10):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        self.write_behind.flush()
+        with self.get_cursor() as cursor:
             if trans_type:
                 cursor.execute("""
                     SELECT type, amount, description, created_at 
@@ -332,35 +673,99 @@ class Database:
                     ORDER BY created_at DESC LIMIT ?
                 """, (user_id, limit))
             return cursor.fetchall()
-        finally:
-            conn.close()
     
     def add_star_purchase(self, user_id, recipient_username, stars_amount, balance_spent, tx_hash=None, status='pending'):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 INSERT INTO star_purchases (user_id, recipient_username, stars_amount, balance_spent, tx_hash, status)
                 VALUES (?, ?, ?, ?, ?, ?)
             """, (user_id, recipient_username, stars_amount, balance_spent, tx_hash, status))
-            conn.commit()
             return cursor.lastrowid
-        finally:
-            conn.close()
     
     def update_star_purchase(self, purchase_id, tx_hash, status):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("UPDATE star_purchases SET tx_hash = ?, status = ? WHERE id = ?", (tx_hash, status, purchase_id))
-            conn.commit()
-        finally:
-            conn.close()
+        with self.get_cursor() as cursor:
+            cursor.execute("UPDATE star_purchases SET tx_hash = ?, status = ?, updated_at = ? WHERE id = ?", (tx_hash, status, datetime.now(), purchase_id))
+    
+    def enqueue_star_purchase(self, user_id, recipient_username, recipient_id, stars_amount, balance_spent, prefetched_order=None):
+        # Средства резервируются сразу при постановке в очередь; None - если баланса не хватает.
+        # prefetched_order - заранее полученный заказ Fragment (JSON), его подхватит воркер любого процесса
+        with self.transaction():
+            if not self.debit_balance(user_id, balance_spent):
+                return None
+            with self.get_cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO star_purchases (user_id, recipient_username, recipient_id, stars_amount, balance_spent, status, updated_at, prefetched_order)
+                    VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)
+                """, (user_id, recipient_username, recipient_id, stars_amount, balance_spent, datetime.now(), prefetched_order))
+                return cursor.lastrowid
+    
+    def mark_star_purchase_sent(self, purchase_id, tx_hash, seqno, valid_until, ton_destination, ton_amount, body_hash):
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                UPDATE star_purchases
+                SET tx_hash = ?, seqno = ?, valid_until = ?, ton_destination = ?, ton_amount = ?, body_hash = ?, status = 'sent', updated_at = ?
+                WHERE id = ?
+            """, (tx_hash, seqno, valid_until, ton_destination, ton_amount, body_hash, datetime.now(), purchase_id))
+    
+    def get_sent_star_purchases(self):
+        # Переводы отправлены, но еще не подтверждены в сети
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT id, user_id, recipient_username, stars_amount, balance_spent, tx_hash, updated_at, seqno, valid_until,
+                       ton_destination, ton_amount, body_hash
+                FROM star_purchases
+                WHERE status = 'sent'
+                ORDER BY id
+            """)
+            return cursor.fetchall()
+    
+    def settle_star_purchase(self, purchase_id, user_id, balance_spent, confirmed, description):
+        # Итог перевода по данным блокчейна: списание в журнал или возврат средств.
+        # Переход только из 'sent', поэтому повторный вызов (в том числе из другого процесса) ничего не меняет
+        with self.transaction(), self.get_cursor() as cursor:
+            cursor.execute("UPDATE star_purchases SET status = ?, updated_at = ? WHERE id = ? AND status = 'sent'", ("completed" if confirmed else "failed", datetime.now(), purchase_id))
+            if cursor.rowcount == 0:
+                return False
+            if confirmed:
+                self.add_transaction(user_id, "purchase", -balance_spent, description)
+            else:
+                self.add_balance(user_id, balance_spent)
+            return True
+    
+    def fail_star_purchase(self, purchase_id, user_id, balance_spent):
+        # Возврат зарезервированных средств вместе со сменой статуса
+        with self.transaction():
+            self.update_star_purchase(purchase_id, None, "failed")
+            self.add_balance(user_id, balance_spent)
+    
+    def claim_star_purchase(self):
+        with self.transaction(), self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT id, user_id, recipient_username, recipient_id, stars_amount, balance_spent, prefetched_order
+                FROM star_purchases
+                WHERE status = 'queued'
+                ORDER BY id LIMIT 1
+            """)
+            result = cursor.fetchone()
+            if result:
+                cursor.execute("UPDATE star_purchases SET status = 'processing', updated_at = ? WHERE id = ?", (datetime.now(), result[0]))
+            return result
+    
+    def mark_interrupted_star_purchases(self):
+        # Заказы, которые обрабатывались в момент остановки, не перезапускаются и не возвращаются:
+        # TON мог уже уйти, повторная отправка или возврат опаснее ручной проверки
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT id, user_id, stars_amount
+                FROM star_purchases
+                WHERE status = 'processing'
+            """)
+            results = cursor.fetchall()
+            cursor.execute("UPDATE star_purchases SET status = 'interrupted', updated_at = ? WHERE status = 'processing'", (datetime.now(),))
+            return results
     
     def get_user_star_purchases(self, user_id, limit=10):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 SELECT recipient_username, stars_amount, balance_spent, status, created_at 
                 FROM star_purchases 
@@ -368,23 +773,14 @@ class Database:
                 ORDER BY created_at DESC LIMIT ?
             """, (user_id, limit))
             return cursor.fetchall()
-        finally:
-            conn.close()
     
     def create_ticket(self, user_id, subject):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("INSERT INTO tickets (user_id, subject) VALUES (?, ?)", (user_id, subject))
-            conn.commit()
             return cursor.lastrowid
-        finally:
-            conn.close()
     
     def get_user_open_ticket(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 SELECT id, subject, created_at 
                 FROM tickets 
@@ -392,13 +788,9 @@ class Database:
                 ORDER BY created_at DESC LIMIT 1
             """, (user_id,))
             return cursor.fetchone()
-        finally:
-            conn.close()
     
     def get_user_tickets(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 SELECT id, subject, status, created_at 
                 FROM tickets 
@@ -406,43 +798,22 @@ class Database:
                 ORDER BY created_at DESC
             """, (user_id,))
             return cursor.fetchall()
-        finally:
-            conn.close()
     
     def get_ticket(self, ticket_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("SELECT id, user_id, subject, status, created_at FROM tickets WHERE id = ?", (ticket_id,))
             return cursor.fetchone()
-        finally:
-            conn.close()
     
     def close_ticket(self, ticket_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("UPDATE tickets SET status = 'closed', closed_at = ? WHERE id = ?", (datetime.now(), ticket_id))
-            conn.commit()
-        finally:
-            conn.close()
     
     def add_ticket_message(self, ticket_id, user_id, message):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("""
-                INSERT INTO ticket_messages (ticket_id, user_id, message)
-                VALUES (?, ?, ?)
-            """, (ticket_id, user_id, message))
-            conn.commit()
-        finally:
-            conn.close()
+        self.write_later(TICKET_MESSAGE_INSERT_SQL, (ticket_id, user_id, message))
     
     def get_ticket_messages(self, ticket_id, limit=20):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        self.write_behind.flush()
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 SELECT user_id, message, created_at 
                 FROM ticket_messages 
@@ -451,62 +822,87 @@ class Database:
             """, (ticket_id, limit))
             results = cursor.fetchall()
             return list(reversed(results))
-        finally:
-            conn.close()
     
     def get_all_users(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 SELECT user_id, username, first_name, last_name, balance, is_blocked, created_at
                 FROM users ORDER BY created_at DESC
             """)
             return cursor.fetchall()
-        finally:
-            conn.close()
+    
+    def set_bot_blocked(self, user_id):
+        with self.get_cursor() as cursor:
+            cursor.execute("UPDATE users SET is_bot_blocked = 1 WHERE user_id = ?", (user_id,))
+            self.forget_user(user_id)
+    
+    def count_broadcast_recipients(self, after_user_id=0):
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM users WHERE user_id > ? AND is_blocked = 0 AND is_bot_blocked = 0", (after_user_id,))
+            return cursor.fetchone()[0]
+    
+    def get_broadcast_recipients(self, after_user_id, limit):
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT user_id FROM users
+                WHERE user_id > ? AND is_blocked = 0 AND is_bot_blocked = 0
+                ORDER BY user_id LIMIT ?
+            """, (after_user_id, limit))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def create_broadcast(self, admin_id, text, status_message_id):
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO broadcasts (admin_id, text, status_message_id)
+                VALUES (?, ?, ?)
+            """, (admin_id, text, status_message_id))
+            return cursor.lastrowid
+    
+    def get_broadcast(self, broadcast_id):
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT id, admin_id, text, status_message_id, last_user_id, sent, failed, blocked
+                FROM broadcasts WHERE id = ?
+            """, (broadcast_id,))
+            return cursor.fetchone()
+    
+    def get_running_broadcasts(self):
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+            return [row[0] for row in cursor.fetchall()]
+    
+    def update_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, blocked):
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                UPDATE broadcasts
+                SET last_user_id = ?, sent = ?, failed = ?, blocked = ?
+                WHERE id = ?
+            """, (last_user_id, sent, failed, blocked, broadcast_id))
+    
+    def finish_broadcast(self, broadcast_id):
+        with self.get_cursor() as cursor:
+            cursor.execute("UPDATE broadcasts SET status = 'finished', finished_at = ? WHERE id = ?", (datetime.now(), broadcast_id))
     
     def get_stats(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT COUNT(*) FROM users")
-            total_users = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_blocked = 1")
-            blocked_users = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM promo_codes")
-            total_codes = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM promo_codes WHERE is_used = 1")
-            used_codes = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM star_purchases WHERE status = 'completed'")
-            completed_purchases = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT SUM(stars_amount) FROM star_purchases WHERE status = 'completed'")
-            total_stars = cursor.fetchone()[0] or 0
-            
-            cursor.execute("SELECT SUM(balance) FROM users")
-            total_balance = cursor.fetchone()[0] or 0
-            
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT total_users, blocked_users, total_codes, used_codes,
+                       completed_purchases, total_stars, total_balance
+                FROM stats WHERE id = 1
+            """)
+            row = cursor.fetchone()
             return {
-                "total_users": total_users,
-                "blocked_users": blocked_users,
-                "total_codes": total_codes,
-                "used_codes": used_codes,
-                "completed_purchases": completed_purchases,
-                "total_stars": total_stars,
-                "total_balance": total_balance
+                "total_users": row[0],
+                "blocked_users": row[1],
+                "total_codes": row[2],
+                "used_codes": row[3],
+                "completed_purchases": row[4],
+                "total_stars": row[5],
+                "total_balance": row[6]
             }
-        finally:
-            conn.close()
     
     def get_all_open_tickets(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 SELECT t.id, t.user_id, t.subject, t.created_at, u.username, u.first_name
                 FROM tickets t
@@ -515,64 +911,134 @@ class Database:
                 ORDER BY t.created_at DESC
             """)
             return cursor.fetchall()
-        finally:
-            conn.close()
     
     def add_menu_button(self, button_text, button_url=None, button_order=0):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 INSERT INTO menu_buttons (button_text, button_url, button_order)
                 VALUES (?, ?, ?)
             """, (button_text, button_url, button_order))
-            conn.commit()
-            return cursor.lastrowid
-        finally:
-            conn.close()
+            button_id = cursor.lastrowid
+        self.publish("menu")
+        self.load_menu_buttons()
+        return button_id
     
-    def get_menu_buttons(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+    def load_menu_buttons(self):
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 SELECT id, button_text, button_url 
                 FROM menu_buttons 
                 WHERE is_active = 1 
                 ORDER BY button_order
             """)
-            return cursor.fetchall()
-        finally:
-            conn.close()
+            self.menu_buttons = cursor.fetchall()
+        self.menu_version += 1
+    
+    @in_memory
+    def get_menu_buttons(self):
+        return self.menu_buttons
+    
+    @in_memory
+    def get_menu_version(self):
+        # Меняется при каждом изменении кнопок меню, по нему сбрасывается кэш клавиатуры
+        return self.menu_version
     
     def delete_menu_button(self, button_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("DELETE FROM menu_buttons WHERE id = ?", (button_id,))
-            conn.commit()
-            return cursor.rowcount > 0
-        finally:
-            conn.close()
+            deleted = cursor.rowcount > 0
+        if deleted:
+            self.publish("menu")
+            self.load_menu_buttons()
+        return deleted
+    
+    def load_settings(self):
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT key, value FROM settings")
+            self.settings = dict(cursor.fetchall())
     
     def set_setting(self, key, value):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_cursor() as cursor:
             cursor.execute("""
                 INSERT OR REPLACE INTO settings (key, value)
                 VALUES (?, ?)
             """, (key, value))
-            conn.commit()
-        finally:
-            conn.close()
+        self.publish("settings")
+        self.settings = {**self.settings, key: value}
     
+    @in_memory
     def get_setting(self, key, default=None):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-            result = cursor.fetchone()
-            return result[0] if result else default
-        finally:
-            conn.close()
+        return self.settings.get(key, default)
+    
+    def enable_shared_cache(self):
+        # Включается в процессах-воркерах: изменения пишутся в cache_invalidations,
+        # а sync() применяет чужие изменения к своим кэшам
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations")
+            self.invalidation_id = cursor.fetchone()[0]
+        self.shared = True
+    
+    def publish(self, kind, key=None):
+        if self.shared:
+            self.write_later(INVALIDATION_INSERT_SQL, (kind, key))
+    
+    def sync(self):
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT id, kind, key FROM cache_invalidations WHERE id > ? ORDER BY id", (self.invalidation_id,))
+            rows = cursor.fetchall()
+            self.sync_count += 1
+            if self.sync_count % INVALIDATION_PRUNE_EVERY == 0:
+                cursor.execute("DELETE FROM cache_invalidations WHERE created_at < datetime('now', ?)", (INVALIDATION_KEEP,))
+        if not rows:
+            return
+        self.invalidation_id = rows[-1][0]
+        kinds = {kind for _, kind, _ in rows}
+        for _, kind, key in rows:
+            if kind == "user":
+                self.users_cache.pop(key)
+        blocked = [key for _, kind, key in rows if kind == "blocked"]
+        if blocked:
+            with self.get_cursor() as cursor:
+                cursor.execute(f"SELECT user_id FROM users WHERE is_blocked = 1 AND user_id IN ({','.join('?' * len(blocked))})", blocked)
+                now_blocked = {row[0] for row in cursor.fetchall()}
+            self.blocked_users = (self.blocked_users - set(blocked)) | now_blocked
+        if "settings" in kinds:
+            self.load_settings()
+        if "menu" in kinds:
+            self.load_menu_buttons()
+
+
+class AsyncDatabase:
+    # Тот же набор методов, что и у Database, но каждый вызов awaitable:
+    # запросы выполняются в отдельном потоке БД и не блокируют event loop
+    def __init__(self, db_name="shop_bot.db"):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+        self.db = Database(db_name)
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        if getattr(method, "in_memory", False):
+            async def call(*args, **kwargs):
+                return method(*args, **kwargs)
+            call.__name__ = name
+            return call
+
+        lookup = getattr(method, "memory_lookup", None)
+
+        async def call(*args, **kwargs):
+            if lookup is not None:
+                result = lookup(self.db, *args, **kwargs)
+                if result is not MISSING:
+                    return result
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(method, *args, **kwargs))
+
+        call.__name__ = name
+        return call
+
+    def close(self):
+        self.executor.submit(self.db.close).result()
+        self.executor.shutdown(wait=True)
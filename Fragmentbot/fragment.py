@@ -1,10 +1,18 @@
+import asyncio
 import logging
-import base64
-import re
+import importlib.util
+import time
+from collections import Counter
 import httpx
+from pytoniq_core import Address, Cell, begin_cell
 from tonutils.client import TonapiClient
+from tonutils.utils import to_nano
 from tonutils.wallet import WalletV5R1
+from tonutils.wallet.messages import TransferMessage
 import config
+from cache import MISSING, TTLCache
+from payload_codec import comment_cell
+from resilience import CircuitBreaker, DeadlineExceeded, guarded
 
 def get_cookies():
     return {
@@ -14,29 +22,82 @@ def get_cookies():
         "stel_token": config.DATA.get("stel_token", ""),
     }
 
-def fix_base64_padding(b64_string: str) -> str:
-    missing_padding = len(b64_string) % 4
-    if missing_padding:
-        b64_string += "=" * (4 - missing_padding)
-    return b64_string
+http_client = None
+recipient_cache = TTLCache(maxsize=config.RECIPIENT_CACHE_SIZE, ttl=config.RECIPIENT_CACHE_TTL)
+
+def start_http_client():
+    # Один клиент на процесс: keep-alive соединения к fragment.com переиспользуются между запросами
+    global http_client
+    http2 = config.HTTP2 and importlib.util.find_spec("h2") is not None
+    http_client = httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=60,
+        ),
+        timeout=httpx.Timeout(config.HTTP_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT),
+    )
+    return http_client
+
+def get_http_client():
+    if http_client is None or http_client.is_closed:
+        return start_http_client()
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+fragment_breaker = CircuitBreaker("Fragment", config.BREAKER_FAILURES, config.BREAKER_RESET)
+ton_breaker = CircuitBreaker("TON", config.BREAKER_FAILURES, config.BREAKER_RESET)
+# Покупки проходят через процесс-владелец кошелька, поэтому цепи размыкаются там, а заказы принимает любой воркер.
+# Владелец публикует в settings момент, до которого цепь разомкнута, остальные проверяют его перед приемом заказа
+PURCHASE_BREAKERS = (fragment_breaker, ton_breaker)
+
+def breaker_setting(breaker):
+    return f"breaker_{breaker.name}"
+
+class TransferStateUnknown(Exception):
+    # Перевод ушел в отправку, но результат не получен за TON_DEADLINE: TON мог уйти, возвращать средства нельзя
+    pass
 
 class FragmentClient:
     def get_url(self):
         return f"https://fragment.com/api?hash={config.FRAGMENT_HASH}"
 
     async def fetch_recipient(self, query):
+        # Username в Telegram регистронезависимый; "не найден" тоже кэшируется, но на меньший срок
+        key = query.lower()
+        recipient = recipient_cache.get(key)
+        if recipient is not MISSING:
+            return recipient
+        return await self.search_recipient(query, key)
+
+    @guarded(fragment_breaker, config.FRAGMENT_DEADLINE, retries=config.FRAGMENT_RETRIES)
+    async def search_recipient(self, query, key):
         data = {"query": query, "method": "searchStarsRecipient"}
-        async with httpx.AsyncClient() as client:
-            response = await client.post(self.get_url(), cookies=get_cookies(), data=data)
-            logging.info(f"Fragment API URL: {self.get_url()}")
-            return response.json().get("found", {}).get("recipient")
+        response = await get_http_client().post(self.get_url(), cookies=get_cookies(), data=data)
+        logging.info(f"Fragment API URL: {self.get_url()}")
+        response.raise_for_status()
+        json_data = response.json()
+        if "error" in json_data:
+            return None
+        recipient = json_data.get("found", {}).get("recipient")
+        recipient_cache.set(key, recipient, None if recipient else config.RECIPIENT_CACHE_NEGATIVE_TTL)
+        return recipient
 
+    # Создает новый заказ на Fragment, поэтому без повторов
+    @guarded(fragment_breaker, config.FRAGMENT_DEADLINE)
     async def fetch_req_id(self, recipient, quantity):
         data = {"recipient": recipient, "quantity": quantity, "method": "initBuyStarsRequest"}
-        async with httpx.AsyncClient() as client:
-            response = await client.post(self.get_url(), cookies=get_cookies(), data=data)
-            return response.json().get("req_id")
+        response = await get_http_client().post(self.get_url(), cookies=get_cookies(), data=data)
+        response.raise_for_status()
+        return response.json().get("req_id")
 
+    @guarded(fragment_breaker, config.FRAGMENT_DEADLINE, retries=config.FRAGMENT_RETRIES)
     async def fetch_buy_link(self, recipient, req_id, quantity):
         data = {
             "address": f"{config.FRAGMENT_ADDRES}", 
@@ -61,49 +122,285 @@ class FragmentClient:
             "user-agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
             "x-requested-with": "XMLHttpRequest"
         }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(self.get_url(), headers=headers, cookies=get_cookies(), data=data)
-            json_data = response.json()
-            if json_data.get("ok") and "transaction" in json_data:
-                transaction = json_data["transaction"]
-                return transaction["messages"][0]["address"], transaction["messages"][0]["amount"], transaction["messages"][0]["payload"]
+        response = await get_http_client().post(self.get_url(), headers=headers, cookies=get_cookies(), data=data)
+        response.raise_for_status()
+        json_data = response.json()
+        if json_data.get("ok") and "transaction" in json_data:
+            transaction = json_data["transaction"]
+            return transaction["messages"][0]["address"], transaction["messages"][0]["amount"], transaction["messages"][0]["payload"]
         return None, None, None
 
+async def fetch_order(recipient, quantity):
+    # Заказ на Fragment: req_id и параметры TON перевода, который его оплачивает
+    client = FragmentClient()
+    req_id = await client.fetch_req_id(recipient, quantity)
+    if not req_id:
+        return None
+    address, amount, payload = await client.fetch_buy_link(recipient, req_id, quantity)
+    if not (address and amount and payload):
+        return None
+    if config.PAYLOAD_CAPTURE_FILE:
+        # Настоящие payload для эталонной проверки Fragment-api/bench_payload.py
+        with open(config.PAYLOAD_CAPTURE_FILE, "a") as f:
+            f.write(f"{quantity} {payload}\n")
+    return {"address": address, "amount": amount, "payload": payload}
+
+class OrderPrefetcher:
+    # Заказ запрашивается заранее, пока пользователь нажимает "Подтвердить", и после подтверждения
+    # остается только отправить TON. Заказ привязан к пользователю, выдается один раз
+    # и выбрасывается через ORDER_PREFETCH_TTL секунд, если не пригодился
+    def __init__(self):
+        self.orders = {}
+
+    def prefetch(self, user_id, recipient, quantity):
+        key = (user_id, recipient, quantity)
+        self.discard(key)
+        ttl = config.ORDER_PREFETCH_TTL
+        task = asyncio.create_task(self.load(recipient, quantity))
+        expiry = asyncio.get_running_loop().call_later(ttl, self.discard, key)
+        self.orders[key] = (task, time.time() + ttl, expiry)
+
+    async def load(self, recipient, quantity):
+        try:
+            return await fetch_order(recipient, quantity)
+        except Exception as e:
+            logging.warning(f"Не удалось заранее получить заказ Fragment для {recipient}: {e}")
+            return None
+
+    def discard(self, key):
+        entry = self.orders.pop(key, None)
+        if entry is not None:
+            task, expires_at, expiry = entry
+            task.cancel()
+            expiry.cancel()
+
+    def take(self, user_id, recipient, quantity):
+        # Не ждет незавершенный запрос: в этом случае заказ получит воркер очереди покупок
+        entry = self.orders.pop((user_id, recipient, quantity), None)
+        if entry is None:
+            return None
+        task, expires_at, expiry = entry
+        expiry.cancel()
+        if not task.done():
+            task.cancel()
+            return None
+        order = None if task.cancelled() else task.result()
+        if order is None:
+            return None
+        return {**order, "expires_at": expires_at}
+
+order_prefetcher = OrderPrefetcher()
+
+class WalletManager:
+    # Кошелек выводится из мнемоники один раз и пересоздается только при смене MNEMONIC или API_TON
+    def __init__(self):
+        self.client = None
+        self.wallet = None
+        self.key = None
+
+    def refresh(self):
+        key = (config.API_TON, tuple(config.MNEMONIC))
+        if self.wallet is None or key != self.key:
+            client = TonapiClient(api_key=config.API_TON, is_testnet=False)
+            wallet, public_key, private_key, mnemonic = WalletV5R1.from_mnemonic(client, config.MNEMONIC)
+            self.client, self.wallet, self.key = client, wallet, key
+            logging.info("TON кошелек загружен")
+        return self.wallet
+
+    def get_wallet(self):
+        return self.refresh()
+
+wallet_manager = WalletManager()
+
+TONAPI_URL = "https://tonapi.io/v2"
+TONAPI_PAGE_SIZE = 100
+TONAPI_MAX_PAGES = 20
+
+async def fetch_wallet_transactions(since):
+    # История кошелька магазина начиная с since (unix time): один запрос на все ожидающие покупки,
+    # страницы запрашиваются, пока не дойдем до since. Вторым значением возвращается время,
+    # с которого история полная: since или раньше, если дошли, иначе время самой старой полученной транзакции
+    address = wallet_manager.get_wallet().address.to_str()
+    headers = {"Authorization": f"Bearer {config.API_TON}"}
+    transactions = []
+    before_lt = None
+    for _ in range(TONAPI_MAX_PAGES):
+        params = {"limit": TONAPI_PAGE_SIZE}
+        if before_lt:
+            params["before_lt"] = before_lt
+        response = await get_http_client().get(f"{TONAPI_URL}/blockchain/accounts/{address}/transactions", params=params, headers=headers)
+        response.raise_for_status()
+        page = response.json().get("transactions", [])
+        transactions.extend(page)
+        if len(page) < TONAPI_PAGE_SIZE or page[-1]["utime"] < since:
+            return transactions, 0
+        before_lt = page[-1]["lt"]
+    return transactions, transactions[-1]["utime"]
+
+async def fetch_wallet_seqno():
+    wallet = wallet_manager.get_wallet()
+    return await wallet.get_seqno(wallet.client, wallet.address)
+
+def normalized_message_hash(message):
+    # tonutils возвращает нормализованный хэш внешнего сообщения (только адрес и тело),
+    # а tonapi отдает обычный хэш; нормализованный считается здесь из destination и raw_body
+    if not message or not message.get("raw_body") or not message.get("destination"):
+        return None
+    body = Cell.one_from_boc(bytes.fromhex(message["raw_body"]))
+    cell = (
+        begin_cell()
+        .store_uint(2, 2)
+        .store_address(None)
+        .store_address(Address(message["destination"]["address"]))
+        .store_coins(0)
+        .store_bool(False)
+        .store_bool(True)
+        .store_ref(body)
+        .end_cell()
+    )
+    return cell.hash.hex()
+
+def message_key(destination, amount, body_hash):
+    # Сообщение внутри пачки: адрес, сумма в нанотонах и хэш тела (в комментарии уникальный Ref# заказа)
+    return Address(destination).to_str(is_user_friendly=False), int(amount), body_hash
+
+def out_message_keys(transaction):
+    # Сообщения, которые транзакция действительно отправила. Пропущенные при send_mode=3
+    # (например, когда на них не хватило баланса) в out_msgs не попадают
+    keys = Counter()
+    for message in transaction.get("out_msgs") or []:
+        destination = (message.get("destination") or {}).get("address")
+        if not destination:
+            continue
+        raw_body = message.get("raw_body")
+        body_hash = Cell.one_from_boc(bytes.fromhex(raw_body)).hash.hex() if raw_body else None
+        keys[message_key(destination, message.get("value", 0), body_hash)] += 1
+    return keys
+
+# Переводы с одного кошелька идут строго по одному, иначе параллельные воркеры возьмут один seqno
+wallet_lock = asyncio.Lock()
+# Ограничение WalletV5R1 на число сообщений во внешней транзакции
+MAX_BATCH_MESSAGES = 255
+SEQNO_POLL_INTERVAL = 1
+
+class TonBatchSender:
+    # Копит переводы, пока кошелек занят или идет окно TON_BATCH_WINDOW, и отправляет их одной
+    # транзакцией с несколькими сообщениями: один seqno на пачку вместо одного на покупку.
+    # Следующая пачка уходит только после того, как seqno в сети сдвинулся или сообщение
+    # истекло (valid_until): с тем же seqno одно из двух сообщений было бы молча отброшено
+    def __init__(self):
+        self.pending = []
+        self.timer = None
+        self.draining = False
+
+    async def submit(self, destination, amount, body):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((destination, amount, body, future))
+        if len(self.pending) >= min(config.TON_BATCH_SIZE, MAX_BATCH_MESSAGES):
+            self.flush()
+        elif self.timer is None and not self.draining:
+            self.timer = asyncio.get_running_loop().call_later(config.TON_BATCH_WINDOW, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.draining and self.pending:
+            self.draining = True
+            asyncio.create_task(self.drain())
+
+    async def drain(self):
+        # Все, что накопилось за время отправки предыдущей пачки, уходит следующей пачкой
+        try:
+            while self.pending:
+                size = min(config.TON_BATCH_SIZE, MAX_BATCH_MESSAGES)
+                batch, self.pending = self.pending[:size], self.pending[size:]
+                await self.send(batch)
+        finally:
+            self.draining = False
+
+    async def send(self, batch):
+        async with wallet_lock:
+            wallet = wallet_manager.get_wallet()
+            try:
+                seqno = await wallet.get_seqno(wallet.client, wallet.address)
+                valid_until = int(time.time() + config.TON_MESSAGE_TTL)
+                tx_hash = await self.transfer(wallet, batch, seqno, valid_until)
+            except Exception as e:
+                for destination, amount, body, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            logging.info(f"Транзакция отправлена: {tx_hash}, seqno {seqno}, сообщений: {len(batch)}")
+            for destination, amount, body, future in batch:
+                if not future.done():
+                    # Транзакция общая на пачку, поэтому покупка запоминает и свое сообщение в ней
+                    ton_destination, ton_amount, body_hash = message_key(destination, to_nano(amount), body.hash.hex())
+                    future.set_result({
+                        "hash": tx_hash,
+                        "seqno": seqno,
+                        "valid_until": valid_until,
+                        "destination": ton_destination,
+                        "amount": ton_amount,
+                        "body_hash": body_hash,
+                    })
+            if not await self.wait_seqno(wallet, seqno, valid_until):
+                logging.error(f"Транзакция {tx_hash}: seqno {seqno} не сдвинулся до valid_until, сообщение истекло")
+
+    # Перевод никогда не повторяется: повтор может отправить TON дважды.
+    # Срок действует на отправку пачки, а не на ожидание своей очереди
+    @guarded(ton_breaker, config.TON_DEADLINE)
+    async def transfer(self, wallet, batch, seqno, valid_until):
+        if len(batch) == 1:
+            destination, amount, body, future = batch[0]
+            return await wallet.transfer(destination=destination, amount=amount, body=body, seqno=seqno, valid_until=valid_until)
+        return await wallet.batch_transfer_messages([
+            TransferMessage(destination=destination, amount=amount, body=body)
+            for destination, amount, body, future in batch
+        ], seqno=seqno, valid_until=valid_until)
+
+    async def wait_seqno(self, wallet, seqno, valid_until):
+        while time.time() <= valid_until:
+            await asyncio.sleep(SEQNO_POLL_INTERVAL)
+            try:
+                if await wallet.get_seqno(wallet.client, wallet.address) > seqno:
+                    return True
+            except Exception as e:
+                logging.warning(f"Не удалось получить seqno кошелька: {e}")
+        return False
+
+ton_batch_sender = TonBatchSender()
+
 class TonTransaction:
     async def send_ton_transaction(self, recipient, amount_nano, la, stars):
-        client = TonapiClient(api_key=config.API_TON, is_testnet=False)
-        wallet, public_key, private_key, mnemonic = WalletV5R1.from_mnemonic(client, config.MNEMONIC)
-
         if not recipient or amount_nano <= 0:
             return None
 
-        encoded_str = la
-        decoded_bytes = base64.b64decode(fix_base64_padding(encoded_str))
-        decoded_text = "".join(chr(b) if 32 <= b < 127 else " " for b in decoded_bytes)
-        clean_text = re.sub(r"\s+", " ", decoded_text).strip()
-        match = re.search(rf"{stars} Telegram Stars.*", clean_text)
-        final_text = match.group(0) if match else clean_text
-
-        tx_hash = await wallet.transfer(
-            destination=recipient,
-            amount=amount_nano,
-            body=final_text,
-        )
-        logging.info(f"Транзакция отправлена: {tx_hash}")
-        return tx_hash
-
-async def buy_stars_process(QUERY, QUANTITY):
-    client = FragmentClient()
-    recipient = await client.fetch_recipient(QUERY)
-    if recipient:
-        req_id = await client.fetch_req_id(recipient, QUANTITY)
-        if req_id:
-            recipient_addr, amount_nano, la = await client.fetch_buy_link(recipient, req_id, QUANTITY)
-            if recipient_addr and amount_nano and la:
-                amount_decimal = float(amount_nano) / 1_000_000_000
-                logging.info(f"Сумма для отправки: {amount_decimal:.4f} TON")
-                transaction = TonTransaction()
-                tx_hash = await transaction.send_ton_transaction(recipient_addr, amount_decimal, la, QUANTITY)
-                if tx_hash:
-                    return True, tx_hash
+        # Комментарий уходит ячейкой из payload без изменений, а не очищенным текстом:
+        # так сохраняются переводы строк и продолжение длинного комментария в дочерней ячейке
+        body = comment_cell(la)
+
+        try:
+            return await ton_batch_sender.submit(recipient, amount_nano, body)
+        except DeadlineExceeded as e:
+            raise TransferStateUnknown(f"TON перевод: {e}")
+
+async def buy_stars_process(QUERY, QUANTITY, recipient=None, order=None):
+    if order and order.get("expires_at", 0) <= time.time():
+        logging.info("Заранее полученный заказ Fragment истек, запрашиваю новый")
+        order = None
+    if order is None:
+        client = FragmentClient()
+        if not recipient:
+            recipient = await client.fetch_recipient(QUERY)
+        if recipient:
+            order = await fetch_order(recipient, QUANTITY)
+    if order:
+        amount_decimal = float(order["amount"]) / 1_000_000_000
+        logging.info(f"Сумма для отправки: {amount_decimal:.4f} TON")
+        transaction = TonTransaction()
+        transfer = await transaction.send_ton_transaction(order["address"], amount_decimal, order["payload"], QUANTITY)
+        if transfer:
+            return True, transfer
     return False, None
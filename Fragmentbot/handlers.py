@@ -1,13 +1,18 @@
-import asyncio
 import logging
-import httpx
+import time
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from config import ADMIN_IDS, SHOP_NAME, GROQ_API_KEY, DAILY_BONUS_AMOUNT, STAR_PRICE_RUB, update_config, get_config, reload_config
-from fragment import FragmentClient, buy_stars_process
+from config import ADMIN_IDS, SHOP_NAME, DAILY_BONUS_AMOUNT, STAR_PRICE_RUB, AI_EDIT_INTERVAL, update_config, get_config, reload_config
+from fragment import PURCHASE_BREAKERS, FragmentClient, breaker_setting, order_prefetcher, wallet_manager
+from assistant import TELEGRAM_MESSAGE_LIMIT, answer_cache, split_message, stream_groq_response
+from database import USER_FIELDS
+
+FRAGMENT_UNAVAILABLE_TEXT = "⚠️ Fragment временно недоступен, попробуйте позже."
+PURCHASES_PAUSED_TEXT = "⚠️ Покупка временно недоступна: сервис оплаты не отвечает. Попробуйте через минуту."
 
 class BuyStars(StatesGroup):
     waiting_for_stars = State()
@@ -43,44 +48,30 @@ class AdminStates(StatesGroup):
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
-async def get_groq_response(question):
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "llama3-8b-8192",
-                    "messages": [
-                        {"role": "system", "content": f"Ты помощник магазина {SHOP_NAME}. Мы продаем Telegram Stars. Отвечай кратко и по делу на русском языке."},
-                        {"role": "user", "content": question}
-                    ]
-                },
-                timeout=30.0
-            )
-            if response.status_code == 200:
-                return response.json()["choices"][0]["message"]["content"]
-    except:
-        pass
-    return "Извините, ИИ-помощник временно недоступен."
+# Готовые клавиатуры главного меню: {is_admin: (версия кнопок меню, клавиатура)}
+main_menu_keyboards = {}
 
-def get_main_menu_keyboard(db, user_id):
+async def get_main_menu_keyboard(db, user_id):
+    admin = is_admin(user_id)
+    version = await db.get_menu_version()
+    cached = main_menu_keyboards.get(admin)
+    if cached and cached[0] == version:
+        return cached[1]
     keyboard = [
         [InlineKeyboardButton(text="⭐️ Купить звезды", callback_data="buy_stars")],
         [InlineKeyboardButton(text="👤 Профиль", callback_data="profile"), InlineKeyboardButton(text="🆘 Поддержка", callback_data="support")]
     ]
-    menu_buttons = db.get_menu_buttons()
+    menu_buttons = await db.get_menu_buttons()
     for btn_id, btn_text, btn_url in menu_buttons:
         if btn_url:
             keyboard.append([InlineKeyboardButton(text=btn_text, url=btn_url)])
         else:
             keyboard.append([InlineKeyboardButton(text=btn_text, callback_data=f"custom_{btn_id}")])
-    if is_admin(user_id):
+    if admin:
         keyboard.append([InlineKeyboardButton(text="🔥 Админ-меню", callback_data="admin_menu")])
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+    main_menu_keyboards[admin] = (version, markup)
+    return markup
 
 def get_back_to_menu_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💙 Главное меню", callback_data="main_menu")]])
@@ -151,26 +142,30 @@ async def show_main_menu(message_or_callback, db, edit=False):
     else:
         user_id = message_or_callback.from_user.id
         message = message_or_callback
-    balance = db.get_balance(user_id)
+    balance = await db.get_balance(user_id)
     text = f"💙 Главное меню\n\n💰 Ваш баланс: {balance:.2f} ₽"
+    keyboard = await get_main_menu_keyboard(db, user_id)
     if edit and isinstance(message_or_callback, CallbackQuery):
         try:
-            await message.edit_text(text, reply_markup=get_main_menu_keyboard(db, user_id))
+            await message.edit_text(text, reply_markup=keyboard)
         except:
-            await message.answer(text, reply_markup=get_main_menu_keyboard(db, user_id))
+            await message.answer(text, reply_markup=keyboard)
     else:
-        await message.answer(text, reply_markup=get_main_menu_keyboard(db, user_id))
+        await message.answer(text, reply_markup=keyboard)
+
+async def purchases_paused(db):
+    for breaker in PURCHASE_BREAKERS:
+        if breaker.is_open or float(await db.get_setting(breaker_setting(breaker), 0)) > time.time():
+            return True
+    return False
 
-def register_all_handlers(dp: Dispatcher, db, bot: Bot):
+def register_all_handlers(dp: Dispatcher, db, bot: Bot, purchase_queue, broadcast_engine):
     
     @dp.message(Command("start"))
     async def cmd_start(message: types.Message, state: FSMContext):
         user = message.from_user
-        db.add_user(user.id, user.username, user.first_name, user.last_name)
-        if db.is_user_blocked(user.id):
-            await message.answer("🚫 Вы заблокированы и не можете использовать бота.")
-            return
-        if db.is_user_welcomed(user.id):
+        await db.add_user(user.id, user.username, user.first_name, user.last_name)
+        if await db.is_user_welcomed(user.id):
             await show_main_menu(message, db)
         else:
             keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✔️ Продолжить", callback_data="continue_welcome")]])
@@ -178,7 +173,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     
     @dp.callback_query(F.data == "continue_welcome")
     async def continue_welcome(callback: CallbackQuery):
-        db.set_welcomed(callback.from_user.id)
+        await db.set_welcomed(callback.from_user.id)
         await callback.message.delete()
         await show_main_menu(callback, db)
     
@@ -201,9 +196,9 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             if stars <= 0:
                 await message.answer("❌ Количество звезд должно быть больше 0.")
                 return
-            star_price = float(db.get_setting("star_price", STAR_PRICE_RUB))
+            star_price = float(await db.get_setting("star_price", STAR_PRICE_RUB))
             total_cost = stars * star_price
-            user_balance = db.get_balance(message.from_user.id)
+            user_balance = await db.get_balance(message.from_user.id)
             if user_balance < total_cost:
                 await message.answer(f"❌ Недостаточно средств!\n\nСтоимость: {total_cost:.2f} ₽\nВаш баланс: {user_balance:.2f} ₽\nНе хватает: {(total_cost - user_balance):.2f} ₽", reply_markup=get_back_to_menu_keyboard())
                 return
@@ -222,13 +217,19 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             username = f"@{username}"
         checking_msg = await message.answer("🔍 Проверяю аккаунт...")
         client = FragmentClient()
-        recipient = await client.fetch_recipient(username)
+        try:
+            recipient = await client.fetch_recipient(username)
+        except Exception as e:
+            logging.error(f"Проверка получателя {username}: {e}")
+            await checking_msg.delete()
+            await message.answer(FRAGMENT_UNAVAILABLE_TEXT, reply_markup=get_back_keyboard("buy_stars"))
+            return
         await checking_msg.delete()
         if not recipient:
             await message.answer("❌ Аккаунт не найден в Fragment.", reply_markup=get_back_keyboard("buy_stars"))
             return
-        await state.update_data(recipient_username=username)
-        data = await state.get_data()
+        data = await state.update_data(recipient_username=username, recipient_id=recipient)
+        order_prefetcher.prefetch(message.from_user.id, recipient, data.get("stars_amount"))
         recipient = data.get("recipient_username")
         stars = data.get("stars_amount")
         total_cost = data.get("total_cost")
@@ -245,13 +246,19 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             return
         checking_msg = await callback.message.answer("🔍 Проверяю аккаунт...")
         client = FragmentClient()
-        recipient = await client.fetch_recipient(username)
+        try:
+            recipient = await client.fetch_recipient(username)
+        except Exception as e:
+            logging.error(f"Проверка получателя {username}: {e}")
+            await checking_msg.delete()
+            await callback.message.answer(FRAGMENT_UNAVAILABLE_TEXT, reply_markup=get_back_keyboard("buy_stars"))
+            return
         await checking_msg.delete()
         if not recipient:
             await callback.message.answer("❌ Аккаунт не найден.", reply_markup=get_back_keyboard("buy_stars"))
             return
-        await state.update_data(recipient_username=username)
-        data = await state.get_data()
+        data = await state.update_data(recipient_username=username, recipient_id=recipient)
+        order_prefetcher.prefetch(user.id, recipient, data.get("stars_amount"))
         recipient = data.get("recipient_username")
         stars = data.get("stars_amount")
         total_cost = data.get("total_cost")
@@ -261,40 +268,33 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     
     @dp.callback_query(F.data == "confirm_purchase", BuyStars.waiting_for_confirm)
     async def process_confirm_purchase(callback: CallbackQuery, state: FSMContext):
+        # Пока Fragment или TON недоступны, заказ не принимаем: он бы только ждал в очереди и вернулся.
+        # Покупки идут через процесс-владелец, поэтому кроме своих цепей смотрим опубликованное им состояние
+        if await purchases_paused(db):
+            await callback.answer(PURCHASES_PAUSED_TEXT, show_alert=True)
+            return
         data = await state.get_data()
         recipient = data.get("recipient_username")
         stars = data.get("stars_amount")
         total_cost = data.get("total_cost")
         await callback.message.delete()
-        sending_msg = await callback.message.answer("🎁 Отправляю...")
-        purchase_id = db.add_star_purchase(callback.from_user.id, recipient, stars, total_cost)
-        try:
-            success, tx_hash = await buy_stars_process(recipient, stars)
-            await asyncio.sleep(5)
-            await sending_msg.delete()
-            if success and tx_hash:
-                db.subtract_balance(callback.from_user.id, total_cost)
-                db.update_star_purchase(purchase_id, tx_hash, "completed")
-                db.add_transaction(callback.from_user.id, "purchase", -total_cost, f"Покупка {stars} звезд")
-                await callback.message.answer(f"✅ Успешно!\n\n⭐️ Отправлено: {stars}\n👤 Получатель: {recipient}\n💰 Списано: {total_cost:.2f} ₽\n\n🔗 https://tonviewer.com/transaction/{tx_hash}\n\nСделано с 💙", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💙 Главное меню", callback_data="main_menu")]]))
-            else:
-                db.update_star_purchase(purchase_id, None, "failed")
-                await callback.message.answer("❌ Ошибка. Обратитесь к админу.", reply_markup=get_back_to_menu_keyboard())
-        except Exception as e:
-            logging.error(f"Ошибка: {e}")
-            db.update_star_purchase(purchase_id, None, "failed")
-            await callback.message.answer(f"❌ Ошибка: {str(e)}", reply_markup=get_back_to_menu_keyboard())
         await state.clear()
+        order = order_prefetcher.take(callback.from_user.id, data.get("recipient_id"), stars)
+        purchase_id = await purchase_queue.enqueue(callback.from_user.id, recipient, data.get("recipient_id"), stars, total_cost, order)
+        if purchase_id is None:
+            await callback.message.answer("❌ Недостаточно средств!", reply_markup=get_back_to_menu_keyboard())
+            return
+        await callback.message.answer("🎁 Отправляю... Сообщим, как только звезды будут доставлены.")
     
     @dp.callback_query(F.data == "profile")
     async def profile_callback(callback: CallbackQuery):
         await callback.message.delete()
-        user = db.get_user(callback.from_user.id)
-        user_id, username, first_name, last_name, balance, is_blocked, is_welcomed, created_at, last_daily = user
-        name = f"{first_name or ''} {last_name or ''}".strip() or "Без имени"
-        username_text = f"@{username}" if username else "Без username"
-        created_date = created_at[:10] if created_at else "Неизвестно"
-        await callback.message.answer(f"👤 Профиль\n\n🆔 ID: <code>{user_id}</code>\n📝 Username: {username_text}\n👤 Имя: {name}\n💰 Баланс: {balance:.2f} ₽\n📅 Регистрация: {created_date}", reply_markup=get_profile_keyboard(), parse_mode="HTML")
+        user = await db.get_user(callback.from_user.id)
+        profile = dict(zip(USER_FIELDS, user))
+        name = f"{profile['first_name'] or ''} {profile['last_name'] or ''}".strip() or "Без имени"
+        username_text = f"@{profile['username']}" if profile["username"] else "Без username"
+        created_date = profile["created_at"][:10] if profile["created_at"] else "Неизвестно"
+        await callback.message.answer(f"👤 Профиль\n\n🆔 ID: <code>{profile['user_id']}</code>\n📝 Username: {username_text}\n👤 Имя: {name}\n💰 Баланс: {profile['balance']:.2f} ₽\n📅 Регистрация: {created_date}", reply_markup=get_profile_keyboard(), parse_mode="HTML")
     
     @dp.callback_query(F.data == "add_balance")
     async def add_balance_callback(callback: CallbackQuery):
@@ -302,10 +302,8 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     
     @dp.callback_query(F.data == "daily_bonus")
     async def daily_bonus_callback(callback: CallbackQuery):
-        if db.can_claim_daily_bonus(callback.from_user.id):
-            bonus_amount = float(db.get_setting("daily_bonus", DAILY_BONUS_AMOUNT))
-            db.claim_daily_bonus(callback.from_user.id, bonus_amount)
-            db.add_transaction(callback.from_user.id, "bonus", bonus_amount, "Ежедневный бонус")
+        bonus_amount = float(await db.get_setting("daily_bonus", DAILY_BONUS_AMOUNT))
+        if await db.can_claim_daily_bonus(callback.from_user.id) and await db.claim_daily_bonus(callback.from_user.id, bonus_amount):
             await callback.answer(f"🎁 Получено {bonus_amount:.2f} ₽!", show_alert=True)
             await profile_callback(callback)
         else:
@@ -320,24 +318,23 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     @dp.message(ProfileStates.waiting_for_promo_code)
     async def process_promo_code(message: types.Message, state: FSMContext):
         code = message.text.strip()
-        promo = db.check_promo_code(code)
+        promo = await db.check_promo_code(code)
         if not promo:
             await message.answer("❌ Код не найден.", reply_markup=get_back_keyboard("profile"))
             return
         if promo["is_used"]:
             await message.answer("❌ Код использован.", reply_markup=get_back_keyboard("profile"))
             return
-        if db.use_promo_code(code, message.from_user.id):
-            db.add_balance(message.from_user.id, promo["balance_amount"])
-            db.add_transaction(message.from_user.id, "promo", promo["balance_amount"], f"Промокод {code}")
-            await message.answer(f"✅ Активирован!\n\n💰 Начислено: {promo['balance_amount']:.2f} ₽", reply_markup=get_back_to_menu_keyboard())
+        amount = await db.redeem_promo_code(code, message.from_user.id)
+        if amount is not None:
+            await message.answer(f"✅ Активирован!\n\n💰 Начислено: {amount:.2f} ₽", reply_markup=get_back_to_menu_keyboard())
         else:
             await message.answer("❌ Ошибка активации.", reply_markup=get_back_keyboard("profile"))
         await state.clear()
     
     @dp.callback_query(F.data == "last_deposits")
     async def last_deposits_callback(callback: CallbackQuery):
-        transactions = db.get_user_transactions(callback.from_user.id, "deposit", 10)
+        transactions = await db.get_user_transactions(callback.from_user.id, "deposit", 10)
         if not transactions:
             await callback.answer("📥 Пополнений нет", show_alert=True)
             return
@@ -349,13 +346,13 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     
     @dp.callback_query(F.data == "last_purchases")
     async def last_purchases_callback(callback: CallbackQuery):
-        purchases = db.get_user_star_purchases(callback.from_user.id, 10)
+        purchases = await db.get_user_star_purchases(callback.from_user.id, 10)
         if not purchases:
             await callback.answer("📤 Покупок нет", show_alert=True)
             return
         text = "📤 Последние покупки:\n\n"
         for recipient, stars, balance_spent, status, created_at in purchases:
-            status_emoji = "✅" if status == "completed" else "❌"
+            status_emoji = "✅" if status == "completed" else "⏳" if status in ("queued", "processing", "sent") else "❌"
             text += f"{status_emoji} {stars} ⭐️ → {recipient}\n💰 {balance_spent:.2f} ₽\n📅 {created_at[:19]}\n\n"
         await callback.message.delete()
         await callback.message.answer(text, reply_markup=get_back_keyboard("profile"))
@@ -363,12 +360,13 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     @dp.callback_query(F.data == "support")
     async def support_callback(callback: CallbackQuery):
         await callback.message.delete()
-        text = f"🆘 Поддержка\n\n❓ FAQ:\n\nQ: Как купить?\nA: Пополните баланс, выберите звезды.\n\nQ: Как пополнить?\nA: Через профиль.\n\nQ: Цена?\nA: {db.get_setting('star_price', STAR_PRICE_RUB)} ₽"
+        star_price = await db.get_setting("star_price", STAR_PRICE_RUB)
+        text = f"🆘 Поддержка\n\n❓ FAQ:\n\nQ: Как купить?\nA: Пополните баланс, выберите звезды.\n\nQ: Как пополнить?\nA: Через профиль.\n\nQ: Цена?\nA: {star_price} ₽"
         await callback.message.answer(text, reply_markup=get_support_keyboard())
     
     @dp.callback_query(F.data == "create_ticket")
     async def create_ticket_callback(callback: CallbackQuery, state: FSMContext):
-        if db.get_user_open_ticket(callback.from_user.id):
+        if await db.get_user_open_ticket(callback.from_user.id):
             await callback.answer("❌ Уже есть открытый тикет!", show_alert=True)
             return
         await callback.message.delete()
@@ -386,8 +384,8 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     async def process_ticket_message(message: types.Message, state: FSMContext):
         data = await state.get_data()
         subject = data.get("ticket_subject")
-        ticket_id = db.create_ticket(message.from_user.id, subject)
-        db.add_ticket_message(ticket_id, message.from_user.id, message.text)
+        ticket_id = await db.create_ticket(message.from_user.id, subject)
+        await db.add_ticket_message(ticket_id, message.from_user.id, message.text)
         for admin_id in ADMIN_IDS:
             try:
                 await bot.send_message(admin_id, f"🎫 Новый тикет #{ticket_id}\n\n👤 От: {message.from_user.first_name} (@{message.from_user.username or 'нет'})\n🆔 ID: {message.from_user.id}\n📋 Тема: {subject}\n💬 {message.text}", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="📩 Ответить", callback_data=f"admin_reply_{ticket_id}")]]))
@@ -398,7 +396,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     
     @dp.callback_query(F.data == "my_tickets")
     async def my_tickets_callback(callback: CallbackQuery):
-        tickets = db.get_user_tickets(callback.from_user.id)
+        tickets = await db.get_user_tickets(callback.from_user.id)
         if not tickets:
             await callback.answer("🎫 Тикетов нет", show_alert=True)
             return
@@ -413,11 +411,11 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     @dp.callback_query(F.data.startswith("view_ticket_"))
     async def view_ticket_callback(callback: CallbackQuery):
         ticket_id = int(callback.data.split("_")[2])
-        ticket = db.get_ticket(ticket_id)
+        ticket = await db.get_ticket(ticket_id)
         if not ticket or ticket[1] != callback.from_user.id:
             await callback.answer("❌ Тикет не найден", show_alert=True)
             return
-        messages = db.get_ticket_messages(ticket_id)
+        messages = await db.get_ticket_messages(ticket_id)
         text = f"🎫 Тикет #{ticket_id}\n📋 Тема: {ticket[2]}\n\n💬 Диалог:\n\n"
         for msg_user_id, msg_text, msg_created_at in messages:
             if msg_user_id == callback.from_user.id:
@@ -444,7 +442,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     async def process_ticket_new_message(message: types.Message, state: FSMContext):
         data = await state.get_data()
         ticket_id = data.get("ticket_id")
-        db.add_ticket_message(ticket_id, message.from_user.id, message.text)
+        await db.add_ticket_message(ticket_id, message.from_user.id, message.text)
         for admin_id in ADMIN_IDS:
             try:
                 await bot.send_message(admin_id, f"💬 Новое сообщение в тикете #{ticket_id}\n\n👤 От: {message.from_user.first_name}\n💬 {message.text}", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="📩 Ответить", callback_data=f"admin_reply_{ticket_id}")]]))
@@ -456,9 +454,9 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     @dp.callback_query(F.data.startswith("close_ticket_"))
     async def close_ticket_callback(callback: CallbackQuery):
         ticket_id = int(callback.data.split("_")[2])
-        ticket = db.get_ticket(ticket_id)
+        ticket = await db.get_ticket(ticket_id)
         if ticket and ticket[1] == callback.from_user.id:
-            db.close_ticket(ticket_id)
+            await db.close_ticket(ticket_id)
             await callback.answer("✅ Тикет закрыт", show_alert=True)
             await callback.message.delete()
             await support_callback(callback)
@@ -472,9 +470,27 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     @dp.message(TicketStates.waiting_for_ai_question)
     async def process_ai_question(message: types.Message, state: FSMContext):
         thinking_msg = await message.answer("🤔 Думаю...")
-        response = await get_groq_response(message.text)
-        await thinking_msg.delete()
-        await message.answer(f"🤖 Ответ:\n\n{response}", reply_markup=get_back_keyboard("support"))
+        # Ответ появляется по мере генерации: одно сообщение редактируется не чаще AI_EDIT_INTERVAL
+        response = None
+        last_edit = time.monotonic()
+        async for response in stream_groq_response(message.text):
+            if time.monotonic() - last_edit >= AI_EDIT_INTERVAL:
+                last_edit = time.monotonic()
+                # Пока ответ генерируется, показывается его начало, которое помещается в одно сообщение
+                preview = split_message(f"🤖 Ответ:\n\n{response}", TELEGRAM_MESSAGE_LIMIT - 2)[0]
+                try:
+                    await thinking_msg.edit_text(f"{preview} ▌")
+                except TelegramBadRequest:
+                    pass
+        parts = split_message(f"🤖 Ответ:\n\n{response}")
+        # Кнопка возврата - под последней частью ответа
+        keyboards = [None] * (len(parts) - 1) + [get_back_keyboard("support")]
+        try:
+            await thinking_msg.edit_text(parts[0], reply_markup=keyboards[0])
+        except TelegramBadRequest:
+            await message.answer(parts[0], reply_markup=keyboards[0])
+        for part, keyboard in zip(parts[1:], keyboards[1:]):
+            await message.answer(part, reply_markup=keyboard)
         await state.clear()
     
     @dp.callback_query(F.data == "admin_menu")
@@ -514,7 +530,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
                 return
             data = await state.get_data()
             code = data.get("new_code")
-            if db.add_promo_code(code, balance):
+            if await db.add_promo_code(code, balance):
                 await message.answer(f"✅ Промокод добавлен!\n\nКод: <code>{code}</code>\nБаланс: {balance:.2f} ₽", reply_markup=get_admin_keyboard(), parse_mode="HTML")
             else:
                 await message.answer("❌ Промокод существует.", reply_markup=get_admin_keyboard())
@@ -535,7 +551,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
         if not is_admin(message.from_user.id):
             return
         code = message.text.strip()
-        if db.delete_promo_code(code):
+        if await db.delete_promo_code(code):
             await message.answer(f"✅ Промокод <code>{code}</code> удален!", reply_markup=get_admin_keyboard(), parse_mode="HTML")
         else:
             await message.answer("❌ Промокод не найден.", reply_markup=get_admin_keyboard())
@@ -545,7 +561,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     async def admin_list_codes_callback(callback: CallbackQuery):
         if not is_admin(callback.from_user.id):
             return
-        codes = db.get_all_promo_codes()
+        codes = await db.get_all_promo_codes()
         if not codes:
             await callback.message.delete()
             await callback.message.answer("📋 Промокодов нет.", reply_markup=get_back_keyboard("admin_menu"))
@@ -563,7 +579,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     async def admin_list_users_callback(callback: CallbackQuery):
         if not is_admin(callback.from_user.id):
             return
-        users = db.get_all_users()
+        users = await db.get_all_users()
         if not users:
             await callback.message.delete()
             await callback.message.answer("👥 Пользователей нет.", reply_markup=get_back_keyboard("admin_menu"))
@@ -593,7 +609,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             return
         try:
             user_id = int(message.text.strip())
-            if db.block_user(user_id):
+            if await db.block_user(user_id):
                 await message.answer(f"✅ Пользователь <code>{user_id}</code> заблокирован!", reply_markup=get_admin_keyboard(), parse_mode="HTML")
             else:
                 await message.answer("❌ Пользователь не найден.", reply_markup=get_admin_keyboard())
@@ -615,7 +631,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             return
         try:
             user_id = int(message.text.strip())
-            if db.unblock_user(user_id):
+            if await db.unblock_user(user_id):
                 await message.answer(f"✅ Пользователь <code>{user_id}</code> разблокирован!", reply_markup=get_admin_keyboard(), parse_mode="HTML")
             else:
                 await message.answer("❌ Пользователь не найден.", reply_markup=get_admin_keyboard())
@@ -637,7 +653,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             return
         try:
             user_id = int(message.text.strip())
-            if not db.get_user(user_id):
+            if not await db.get_user(user_id):
                 await message.answer("❌ Пользователь не найден.")
                 return
             await state.update_data(target_user_id=user_id)
@@ -657,8 +673,12 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
                 return
             data = await state.get_data()
             user_id = data.get("target_user_id")
-            db.add_balance(user_id, amount)
-            db.add_transaction(user_id, "admin_add", amount, f"Начисление администратором")
+            
+            def credit(tx):
+                tx.add_balance(user_id, amount)
+                tx.add_transaction(user_id, "admin_add", amount, f"Начисление администратором")
+            
+            await db.atomic(credit)
             await message.answer(f"✅ Баланс начислен!\n\nПользователь: <code>{user_id}</code>\nСумма: {amount:.2f} ₽", reply_markup=get_admin_keyboard(), parse_mode="HTML")
             try:
                 await bot.send_message(user_id, f"💰 Вам начислено {amount:.2f} ₽ администратором!")
@@ -680,33 +700,14 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     async def process_broadcast(message: types.Message, state: FSMContext):
         if not is_admin(message.from_user.id):
             return
-        users = db.get_all_users()
-        success_count = 0
-        fail_count = 0
-        status_msg = await message.answer(f"📤 Рассылка: 0/{len(users)}")
-        for idx, user_data in enumerate(users, 1):
-            user_id = user_data[0]
-            is_blocked = user_data[5]
-            if not is_blocked:
-                try:
-                    await bot.send_message(user_id, message.text)
-                    success_count += 1
-                except:
-                    fail_count += 1
-            if idx % 10 == 0:
-                try:
-                    await status_msg.edit_text(f"📤 Рассылка: {idx}/{len(users)}")
-                except:
-                    pass
-        await status_msg.delete()
-        await message.answer(f"✅ Рассылка завершена!\n\nОтправлено: {success_count}\nОшибок: {fail_count}", reply_markup=get_admin_keyboard())
+        await broadcast_engine.create(message.from_user.id, message.text)
         await state.clear()
     
     @dp.callback_query(F.data == "admin_star_price")
     async def admin_star_price_callback(callback: CallbackQuery, state: FSMContext):
         if not is_admin(callback.from_user.id):
             return
-        current_price = db.get_setting("star_price", STAR_PRICE_RUB)
+        current_price = await db.get_setting("star_price", STAR_PRICE_RUB)
         await callback.message.delete()
         await callback.message.answer(f"💲 Текущая цена: {current_price} ₽\n\nВведите новую цену:", reply_markup=get_back_keyboard("admin_menu"))
         await state.set_state(AdminStates.waiting_for_star_price)
@@ -720,7 +721,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             if price <= 0:
                 await message.answer("❌ Цена должна быть больше 0.")
                 return
-            db.set_setting("star_price", str(price))
+            await db.set_setting("star_price", str(price))
             await message.answer(f"✅ Цена изменена на {price:.2f} ₽", reply_markup=get_admin_keyboard())
             await state.clear()
         except ValueError:
@@ -730,7 +731,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     async def admin_daily_bonus_callback(callback: CallbackQuery, state: FSMContext):
         if not is_admin(callback.from_user.id):
             return
-        current_bonus = db.get_setting("daily_bonus", DAILY_BONUS_AMOUNT)
+        current_bonus = await db.get_setting("daily_bonus", DAILY_BONUS_AMOUNT)
         await callback.message.delete()
         await callback.message.answer(f"🎁 Текущий бонус: {current_bonus} ₽\n\nВведите новую сумму:", reply_markup=get_back_keyboard("admin_menu"))
         await state.set_state(AdminStates.waiting_for_daily_bonus)
@@ -744,7 +745,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             if bonus <= 0:
                 await message.answer("❌ Сумма должна быть больше 0.")
                 return
-            db.set_setting("daily_bonus", str(bonus))
+            await db.set_setting("daily_bonus", str(bonus))
             await message.answer(f"✅ Бонус изменен на {bonus:.2f} ₽", reply_markup=get_admin_keyboard())
             await state.clear()
         except ValueError:
@@ -776,7 +777,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             button_url = None
         data = await state.get_data()
         button_text = data.get("button_text")
-        db.add_menu_button(button_text, button_url)
+        await db.add_menu_button(button_text, button_url)
         await message.answer(f"✅ Кнопка добавлена!\n\nТекст: {button_text}\nURL: {button_url or 'Без ссылки'}", reply_markup=get_admin_keyboard())
         await state.clear()
     
@@ -784,7 +785,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     async def admin_delete_button_callback(callback: CallbackQuery, state: FSMContext):
         if not is_admin(callback.from_user.id):
             return
-        buttons = db.get_menu_buttons()
+        buttons = await db.get_menu_buttons()
         if not buttons:
             await callback.answer("❌ Нет кнопок", show_alert=True)
             return
@@ -802,7 +803,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             return
         try:
             button_id = int(message.text.strip())
-            if db.delete_menu_button(button_id):
+            if await db.delete_menu_button(button_id):
                 await message.answer(f"✅ Кнопка ID {button_id} удалена!", reply_markup=get_admin_keyboard())
             else:
                 await message.answer("❌ Кнопка не найдена.", reply_markup=get_admin_keyboard())
@@ -814,7 +815,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     async def admin_tickets_callback(callback: CallbackQuery):
         if not is_admin(callback.from_user.id):
             return
-        tickets = db.get_all_open_tickets()
+        tickets = await db.get_all_open_tickets()
         if not tickets:
             await callback.answer("🎫 Нет открытых тикетов", show_alert=True)
             return
@@ -830,11 +831,11 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
         if not is_admin(callback.from_user.id):
             return
         ticket_id = int(callback.data.split("_")[3])
-        ticket = db.get_ticket(ticket_id)
+        ticket = await db.get_ticket(ticket_id)
         if not ticket:
             await callback.answer("❌ Тикет не найден", show_alert=True)
             return
-        messages = db.get_ticket_messages(ticket_id)
+        messages = await db.get_ticket_messages(ticket_id)
         text = f"🎫 Тикет #{ticket_id}\n📋 Тема: {ticket[2]}\n👤 От: ID {ticket[1]}\n\n💬 Диалог:\n\n"
         for msg_user_id, msg_text, msg_created_at in messages:
             if msg_user_id == ticket[1]:
@@ -861,13 +862,13 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             return
         data = await state.get_data()
         ticket_id = data.get("reply_ticket_id")
-        ticket = db.get_ticket(ticket_id)
+        ticket = await db.get_ticket(ticket_id)
         if not ticket:
             await message.answer("❌ Тикет не найден.")
             await state.clear()
             return
         user_id = ticket[1]
-        db.add_ticket_message(ticket_id, message.from_user.id, message.text)
+        await db.add_ticket_message(ticket_id, message.from_user.id, message.text)
         try:
             await bot.send_message(user_id, f"💬 Новый ответ на тикет #{ticket_id}\n\n👨‍💼 Администратор:\n{message.text}", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="📩 Просмотреть", callback_data=f"view_ticket_{ticket_id}")]]))
         except:
@@ -880,9 +881,9 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
         if not is_admin(callback.from_user.id):
             return
         ticket_id = int(callback.data.split("_")[2])
-        ticket = db.get_ticket(ticket_id)
+        ticket = await db.get_ticket(ticket_id)
         if ticket:
-            db.close_ticket(ticket_id)
+            await db.close_ticket(ticket_id)
             try:
                 await bot.send_message(ticket[1], f"✅ Ваш тикет #{ticket_id} закрыт администратором.")
             except:
@@ -950,6 +951,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
             return
         try:
             reload_config()
+            wallet_manager.refresh()
             await callback.answer("✅ Конфигурация перезагружена!", show_alert=True)
         except Exception as e:
             await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
@@ -958,7 +960,7 @@ def register_all_handlers(dp: Dispatcher, db, bot: Bot):
     async def admin_stats_callback(callback: CallbackQuery):
         if not is_admin(callback.from_user.id):
             return
-        stats = db.get_stats()
-        text = f"📊 Статистика бота\n\n👥 Всего пользователей: <b>{stats['total_users']}</b>\n🚫 Заблокировано: <b>{stats['blocked_users']}</b>\n\n🎫 Всего промокодов: <b>{stats['total_codes']}</b>\n✅ Использовано: <b>{stats['used_codes']}</b>\n\n💳 Завершенных покупок: <b>{stats['completed_purchases']}</b>\n⭐️ Всего выдано звезд: <b>{stats['total_stars']}</b>\n\n💰 Общий баланс пользователей: <b>{stats['total_balance']:.2f} ₽</b>"
+        stats = await db.get_stats()
+        text = f"📊 Статистика бота\n\n👥 Всего пользователей: <b>{stats['total_users']}</b>\n🚫 Заблокировано: <b>{stats['blocked_users']}</b>\n\n🎫 Всего промокодов: <b>{stats['total_codes']}</b>\n✅ Использовано: <b>{stats['used_codes']}</b>\n\n💳 Завершенных покупок: <b>{stats['completed_purchases']}</b>\n⭐️ Всего выдано звезд: <b>{stats['total_stars']}</b>\n\n💰 Общий баланс пользователей: <b>{stats['total_balance']:.2f} ₽</b>\n\n🤖 Кэш ИИ-помощника: <b>{len(answer_cache)}</b> ответов, попаданий <b>{answer_cache.hit_rate():.0%}</b>"
         await callback.message.delete()
         await callback.message.answer(text, reply_markup=get_back_keyboard("admin_menu"), parse_mode="HTML")
@@ -0,0 +1,24 @@
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message
+
+BLOCKED_TEXT = "🚫 Вы заблокированы и не можете использовать бота."
+
+class BlockedUserMiddleware(BaseMiddleware):
+    # Отсекает апдейты заблокированных пользователей до хендлеров;
+    # проверка идет по множеству id в памяти, без запроса к базе
+    def __init__(self, db):
+        self.db = db
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or not await self.db.is_user_blocked(user.id):
+            return await handler(event, data)
+        if isinstance(event, CallbackQuery):
+            await event.answer(BLOCKED_TEXT, show_alert=True)
+        elif isinstance(event, Message):
+            await event.answer(BLOCKED_TEXT)
+
+def register_middlewares(dp, db):
+    blocked = BlockedUserMiddleware(db)
+    dp.message.outer_middleware(blocked)
+    dp.callback_query.outer_middleware(blocked)
@@ -0,0 +1,17 @@
+import base64
+from pytoniq_core import Cell
+
+# Payload из getBuyStarsLink - base64 от BOC ячейки с текстовым комментарием ("50 Telegram Stars ... Ref#...").
+# Боту нужна только сама ячейка. Декодер текста комментария есть только в Fragment-api/api.py:
+# тот файл самодостаточный и из бота не импортируется.
+
+def fix_base64_padding(b64_string):
+    missing_padding = len(b64_string) % 4
+    if missing_padding:
+        b64_string += "=" * (4 - missing_padding)
+    return b64_string
+
+def comment_cell(payload):
+    # Ячейка из payload как есть: комментарий уходит в перевод без потерь
+    # (переводы строк и продолжения длинного текста в дочерних ячейках сохраняются)
+    return Cell.one_from_boc(base64.b64decode(fix_base64_padding(payload)))
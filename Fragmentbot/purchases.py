@@ -0,0 +1,103 @@
+import asyncio
+import json
+import logging
+import config
+from fragment import PURCHASE_BREAKERS, TransferStateUnknown, breaker_setting, buy_stars_process
+from resilience import CircuitOpenError
+from handlers import get_back_to_menu_keyboard
+
+class PurchaseQueue:
+    # Очередь покупок хранится в star_purchases (status = 'queued'), воркеры разбирают ее
+    # с ограниченной параллельностью, поэтому обработчик подтверждения не ждет Fragment и TON
+    def __init__(self, db, bot, workers=None, poll_interval=None):
+        self.db = db
+        self.bot = bot
+        self.workers = workers or config.PURCHASE_WORKERS
+        self.poll_interval = poll_interval or config.PURCHASE_POLL_INTERVAL
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        self.stopping = False
+
+    async def start(self):
+        # Очередь работает в одном процессе, поэтому все заказы в 'processing' остались от его прошлого запуска
+        for purchase_id, user_id, stars in await self.db.mark_interrupted_star_purchases():
+            logging.warning(f"Покупка #{purchase_id} ({stars} звезд, пользователь {user_id}) прервана остановкой бота, средства удержаны, требуется ручная проверка")
+        self.stopping = False
+        self.tasks = [asyncio.create_task(self.worker(i)) for i in range(self.workers)]
+        logging.info(f"Очередь покупок запущена, воркеров: {self.workers}")
+
+    async def stop(self, timeout=None):
+        # Новые заказы больше не берутся, начатые дорабатываются: отмененная покупка осталась бы
+        # в 'processing' и после перезапуска ушла бы на ручную проверку с удержанными средствами
+        self.stopping = True
+        self.wakeup.set()
+        if self.tasks:
+            timeout = timeout or config.PURCHASE_STOP_TIMEOUT
+            done, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            if pending:
+                logging.warning(f"Очередь покупок: за {timeout:g} с не завершено покупок: {len(pending)}, прерываю")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def enqueue(self, user_id, recipient_username, recipient_id, stars, total_cost, order=None):
+        purchase_id = await self.db.enqueue_star_purchase(user_id, recipient_username, recipient_id, stars, total_cost, json.dumps(order) if order else None)
+        self.wakeup.set()
+        return purchase_id
+
+    async def worker(self, number):
+        while not self.stopping:
+            self.wakeup.clear()
+            try:
+                job = await self.db.claim_star_purchase()
+            except Exception as e:
+                logging.error(f"Очередь покупок (воркер {number}): ошибка чтения заказа: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.process(job)
+            await self.share_breakers()
+
+    async def process(self, job):
+        purchase_id, user_id, recipient, recipient_id, stars, total_cost, order = job
+        try:
+            success, transfer = await buy_stars_process(recipient, stars, recipient_id, json.loads(order) if order else None)
+            if success and transfer:
+                # Итог покупки определит ConfirmationTracker, когда перевод появится в сети
+                await self.db.mark_star_purchase_sent(purchase_id, transfer["hash"], transfer["seqno"], transfer["valid_until"], transfer["destination"], transfer["amount"], transfer["body_hash"])
+                await self.notify(user_id, f"🚀 Перевод отправлен, ждем подтверждения в сети.\n\n⭐️ Звезд: {stars}\n👤 Получатель: {recipient}", None)
+            else:
+                await self.db.fail_star_purchase(purchase_id, user_id, total_cost)
+                await self.notify(user_id, "❌ Ошибка. Средства возвращены на баланс. Обратитесь к админу.", get_back_to_menu_keyboard())
+        except CircuitOpenError as e:
+            logging.warning(f"Покупка #{purchase_id} отклонена: {e}")
+            await self.db.fail_star_purchase(purchase_id, user_id, total_cost)
+            await self.notify(user_id, f"⚠️ {e}. Средства возвращены на баланс, попробуйте позже.", get_back_to_menu_keyboard())
+        except TransferStateUnknown as e:
+            logging.error(f"Покупка #{purchase_id}: {e}, требуется ручная проверка")
+            await self.db.update_star_purchase(purchase_id, None, "interrupted")
+            await self.notify(user_id, "⏳ Перевод задерживается. Мы проверим его вручную и сообщим результат.", get_back_to_menu_keyboard())
+        except Exception as e:
+            logging.error(f"Ошибка покупки #{purchase_id}: {e}")
+            await self.db.fail_star_purchase(purchase_id, user_id, total_cost)
+            await self.notify(user_id, f"❌ Ошибка: {str(e)}\n\nСредства возвращены на баланс.", get_back_to_menu_keyboard())
+
+    async def share_breakers(self):
+        for breaker in PURCHASE_BREAKERS:
+            key = breaker_setting(breaker)
+            try:
+                if float(await self.db.get_setting(key, 0)) != breaker.open_until:
+                    await self.db.set_setting(key, breaker.open_until)
+            except Exception as e:
+                logging.error(f"Не удалось сохранить состояние {breaker.name}: {e}")
+
+    async def notify(self, user_id, text, reply_markup):
+        try:
+            await self.bot.send_message(user_id, text, reply_markup=reply_markup)
+        except Exception as e:
+            logging.error(f"Не удалось уведомить пользователя {user_id}: {e}")
@@ -0,0 +1,82 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+
+class CircuitOpenError(Exception):
+    # Сервис признан недоступным: вызов отклонен сразу, без запроса
+    def __init__(self, name):
+        super().__init__(f"{name} временно недоступен")
+        self.name = name
+
+class DeadlineExceeded(Exception):
+    def __init__(self, name, deadline):
+        super().__init__(f"нет ответа за {deadline:g} с")
+        self.name = name
+
+class CircuitBreaker:
+    # После failure_threshold ошибок подряд цепь размыкается на reset_timeout секунд.
+    # Затем пропускается один пробный вызов: успех замыкает цепь, ошибка размыкает снова
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # То же по часам (time.time()): по этому значению состояние цепи видят другие процессы
+        self.open_until = 0
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        if self.is_open:
+            raise CircuitOpenError(self.name)
+        # Пробный вызов: остальные ждут его результата еще reset_timeout
+        self.opened_at = time.monotonic()
+        self.open_until = time.time() + self.reset_timeout
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info(f"{self.name}: доступен снова")
+        self.failures = 0
+        self.opened_at = None
+        self.open_until = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logging.error(f"{self.name}: {self.failures} ошибок подряд, запросы приостановлены на {self.reset_timeout:g} с")
+            self.opened_at = time.monotonic()
+            self.open_until = time.time() + self.reset_timeout
+
+def guarded(breaker, deadline, retries=0, backoff=0.3):
+    # retries > 0 только для идемпотентных шагов: повтор не должен создавать второй заказ или перевод
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(retries + 1):
+                breaker.check()
+                try:
+                    result = await asyncio.wait_for(func(*args, **kwargs), deadline)
+                except Exception as e:
+                    if isinstance(e, asyncio.TimeoutError):
+                        e = DeadlineExceeded(f"{breaker.name}.{func.__name__}", deadline)
+                    if attempt == retries or breaker.is_open:
+                        # Одна ошибка на вызов, а не на попытку: иначе один неудачный запрос с повторами
+                        # засчитывался бы за несколько и размыкал цепь для всех
+                        breaker.record_failure()
+                        raise e
+                    delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                    logging.warning(f"{breaker.name}.{func.__name__}: {e}, повтор через {delay:.1f} с")
+                    await asyncio.sleep(delay)
+                else:
+                    breaker.record_success()
+                    return result
+        return wrapper
+    return decorate
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+import config
+
+BUSY_TIMEOUT_MS = 5000
+
+class SQLiteStorage(BaseStorage):
+    # Состояния FSM в отдельном файле SQLite (WAL): переживают перезапуск и общие
+    # для всех процессов бота на одной машине. Запросы идут в своем потоке, чтобы не блокировать event loop
+    def __init__(self, path=None):
+        self.path = path or config.FSM_STORAGE_PATH
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-storage")
+        self.conn = None
+
+    def get_connection(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS fsm (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL DEFAULT '{}'
+                )
+            """)
+            self.conn = conn
+        return self.conn
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    @staticmethod
+    def make_key(key):
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id, getattr(key, "business_connection_id", None), key.destiny)
+        return ":".join("" if part is None else str(part) for part in parts)
+
+    def fetch(self, key, column):
+        row = self.get_connection().execute(f"SELECT {column} FROM fsm WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def store(self, key, column, value):
+        conn = self.get_connection()
+        conn.execute(f"""
+            INSERT INTO fsm (key, {column}) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}
+        """, (key, value))
+        # Пустые записи не храним, иначе таблица растет на каждого пользователя
+        conn.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+    def merge(self, key, data):
+        conn = self.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = json.loads(self.fetch(key, "data") or "{}")
+            current.update(data)
+            self.store(key, "data", json.dumps(current, ensure_ascii=False))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return current
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await self.run(self.store, self.make_key(key), "state", state)
+
+    async def get_state(self, key):
+        return await self.run(self.fetch, self.make_key(key), "state")
+
+    async def set_data(self, key, data):
+        await self.run(self.store, self.make_key(key), "data", json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key):
+        data = await self.run(self.fetch, self.make_key(key), "data")
+        return json.loads(data) if data else {}
+
+    async def update_data(self, key, data):
+        # Чтение и запись в одной транзакции: параллельные процессы не затирают изменения друг друга
+        return await self.run(self.merge, self.make_key(key), dict(data))
+
+    async def close(self):
+        def close_connection():
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        await self.run(close_connection)
+        self.executor.shutdown(wait=True)
+
+def create_storage():
+    backend = config.FSM_STORAGE.lower()
+    if backend == "redis":
+        # Нужен пакет redis; подойдет любой сервер с протоколом Redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(config.FSM_REDIS_URL)
+    if backend == "memory":
+        return MemoryStorage()
+    return SQLiteStorage()
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+import secrets
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+import config
+
+def create_webhook_app(dp, bot, secret_token, path=None):
+    # Апдейты принимаются по HTTP и обрабатываются в фоновых задачах: Telegram сразу получает 200,
+    # а медленный хендлер не задерживает следующие апдейты. Запросы без верного
+    # X-Telegram-Bot-Api-Secret-Token отклоняются до разбора тела
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret_token, handle_in_background=True).register(app, path=path or config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+def create_routing_app(route, secret_token, path=None):
+    # Режим с воркерами: супервизор не запускает хендлеры, а передает сырой апдейт в route
+    async def handle(request):
+        if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret_token):
+            return web.Response(status=401)
+        await route(await request.json())
+        return web.Response()
+    app = web.Application()
+    app.router.add_post(path or config.WEBHOOK_PATH, handle)
+    return app
+
+async def start_webhook_server(app, host, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+async def run_webhook(dp, bot, route=None):
+    if not config.WEBHOOK_URL:
+        raise RuntimeError("Для режима webhook нужно указать WEBHOOK_URL")
+    # Без заданного секрета генерируется случайный: webhook переустанавливается при каждом запуске
+    secret_token = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    app = create_routing_app(route, secret_token) if route else create_webhook_app(dp, bot, secret_token)
+    runner = await start_webhook_server(app, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    try:
+        await bot.set_webhook(
+            config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info(f"Webhook слушает {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import httpx
+import config
+from webhook import run_webhook
+
+POLL_TIMEOUT = 30
+JOIN_TIMEOUT = 30
+WATCH_INTERVAL = 5
+POLL_MAX_DELAY = 30
+
+def update_user_id(update):
+    # Апдейт содержит update_id и ровно одно событие; пользователь лежит в from, user или chat
+    for key, event in update.items():
+        if key != "update_id" and isinstance(event, dict):
+            owner = event.get("from") or event.get("user") or event.get("chat") or {}
+            return owner.get("id", 0)
+    return 0
+
+def shard_of(update, workers):
+    return hash(update_user_id(update)) % workers
+
+class Supervisor:
+    # Получает апдейты (polling или webhook) и раздает воркерам по hash(user_id):
+    # апдейты одного пользователя всегда попадают в один процесс и обрабатываются по порядку.
+    # Общие у процессов база данных, хранилище FSM и TON кошелек; покупки из всех процессов
+    # ставятся в очередь в базе, а отправляет их только воркер 0
+    def __init__(self, dp, bot, target, workers=None):
+        self.dp = dp
+        self.bot = bot
+        self.target = target
+        self.workers = workers or config.WORKERS
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue(maxsize=config.WORKER_QUEUE_SIZE) for _ in range(self.workers)]
+        self.processes = [None] * self.workers
+
+    def spawn(self, number):
+        process = self.context.Process(target=self.target, args=(number, self.queues[number]), name=f"bot-worker-{number}")
+        process.start()
+        self.processes[number] = process
+
+    def watch(self):
+        for number, process in enumerate(self.processes):
+            if not process.is_alive():
+                logging.error(f"Воркер {number} завершился с кодом {process.exitcode}, перезапускаю")
+                self.spawn(number)
+
+    async def supervise(self):
+        # Проверка воркеров не зависит от способа получения апдейтов
+        while True:
+            self.watch()
+            await asyncio.sleep(WATCH_INTERVAL)
+
+    async def route(self, update):
+        worker_queue = self.queues[shard_of(update, self.workers)]
+        try:
+            worker_queue.put_nowait(update)
+        except queue.Full:
+            # Воркер не успевает: ждем место в очереди, это и есть ограничение входящего потока
+            await asyncio.to_thread(worker_queue.put, update)
+
+    async def run(self):
+        for number in range(self.workers):
+            self.spawn(number)
+        logging.info(f"Супервизор запущен, воркеров: {self.workers}")
+        watcher = asyncio.create_task(self.supervise())
+        try:
+            if config.USE_WEBHOOK:
+                await run_webhook(self.dp, self.bot, self.route)
+            else:
+                await self.poll()
+        finally:
+            watcher.cancel()
+            await asyncio.to_thread(self.stop)
+
+    async def poll(self):
+        # getUpdates без разбора в объекты aiogram: супервизору нужен только user_id
+        await self.bot.delete_webhook()
+        url = self.bot.session.api.api_url(token=self.bot.token, method="getUpdates")
+        allowed_updates = self.dp.resolve_used_update_types()
+        offset = None
+        delay = 1
+        async with httpx.AsyncClient(timeout=POLL_TIMEOUT + 10) as client:
+            while True:
+                try:
+                    response = await client.post(url, json={"offset": offset, "timeout": POLL_TIMEOUT, "allowed_updates": allowed_updates})
+                    data = response.json()
+                except Exception as e:
+                    data = {"description": str(e)}
+                if not data.get("ok"):
+                    # Например, 409: апдейты забирает другой экземпляр бота. Без паузы цикл крутился бы вхолостую
+                    wait = (data.get("parameters") or {}).get("retry_after") or delay
+                    logging.error(f"Ошибка получения апдейтов: {data.get('error_code', '')} {data.get('description')}, повтор через {wait} с")
+                    await asyncio.sleep(wait)
+                    delay = min(delay * 2, POLL_MAX_DELAY)
+                    continue
+                delay = 1
+                for update in data["result"]:
+                    await self.route(update)
+                    offset = update["update_id"] + 1
+
+    def stop(self):
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for number, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                logging.error(f"Воркер {number} не завершился за {JOIN_TIMEOUT} с, останавливаю принудительно")
+                process.terminate()
+
+async def serve_updates(dp, bot, db, updates):
+    # Апдейты разных пользователей обрабатываются параллельно, одного пользователя - строго по очереди
+    loop = asyncio.get_running_loop()
+    sync_task = asyncio.create_task(sync_caches(db))
+    pending = {}
+
+    async def handle(update, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
+
+    def release(user_id, task):
+        if pending.get(user_id) is task:
+            del pending[user_id]
+
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+            user_id = update_user_id(update)
+            task = asyncio.create_task(handle(update, pending.get(user_id)))
+            pending[user_id] = task
+            task.add_done_callback(lambda t, user_id=user_id: release(user_id, t))
+        if pending:
+            await asyncio.wait(list(pending.values()))
+    finally:
+        sync_task.cancel()
+
+async def sync_caches(db):
+    while True:
+        await asyncio.sleep(config.CACHE_SYNC_INTERVAL)
+        try:
+            await db.sync()
+        except Exception as e:
+            logging.error(f"Ошибка синхронизации кэшей: {e}")